@@ -0,0 +1,156 @@
+import asyncio
+import collections
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+class Broadcaster():
+    """ Fans events out to every subscriber of the event stream.
+
+    `publish()` may be called from any thread, events are delivered on the loop
+    the broadcaster was attached to.  Every subscriber has a bounded queue, a
+    subscriber that falls behind loses its oldest events instead of holding up
+    the others.  Recent events are kept so a reconnecting client can resume
+    from the last event id it saw.
+    """
+    queue_size = 100
+    history = 100
+
+    def __init__(self,logger=None):
+        self.logger = logger
+        self.loop = None
+        self.subscribers = set()
+        self.recent = collections.deque(maxlen=self.history)
+        self.last_id = 0
+
+    def attach(self,loop=None):
+        self.loop = loop if loop is not None else asyncio.get_running_loop()
+
+    def publish(self,event):
+        if self.loop is None or self.loop.is_closed():
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            self.deliver(event)
+        else:
+            self.loop.call_soon_threadsafe(self.deliver,event)
+
+    def deliver(self,event):
+        self.last_id += 1
+        entry = (self.last_id,event)
+        self.recent.append(entry)
+        for queue in self.subscribers:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(entry)
+
+    @contextmanager
+    def subscribe(self,last_id=None):
+        """ yields a queue of (id, event), starting after last_id when it is still in the recent events """
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        if last_id is not None:
+            for entry in self.recent:
+                if entry[0] > last_id and not queue.full():
+                    queue.put_nowait(entry)
+        self.subscribers.add(queue)
+        try:
+            yield queue
+        finally:
+            self.subscribers.discard(queue)
+
+def format_sse(event_id,event):
+    lines = [] if event_id is None else [f"id: {event_id}"]
+    lines.extend([f"event: {event['type']}",f"data: {json.dumps(event)}"])
+    return '\n'.join(lines)+'\n\n'
+
+async def poll(fleet,broadcaster,interval=30,drives=None):
+    """ reads every device at `interval` while anyone is subscribed, so changes made outside of the service are streamed too.
+    the strips publish what changed, reads within `state_ttl` are served from their cache.  skipped while drives() is false
+    """
+    while True:
+        if len(broadcaster.subscribers)>0 and (drives is None or drives()):
+            await fleet.astatus()
+        await asyncio.sleep(interval)
+
+class StreamClient():
+    """ Follows an /events/stream endpoint in a background thread for the console.
+
+    Keeps the latest state of every plug and the recent events, and reconnects
+    with backoff, resuming from the last event id it saw.  `changes` counts the
+    state and transition events received, readers compare it to know when data
+    derived from the database is out of date.
+    """
+    history = 200
+
+    def __init__(self,url,logger=None):
+        self.url = url
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.states = {}
+        self.events = collections.deque(maxlen=self.history)
+        self.changes = 0
+        self.connected = False
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run,name="smarthome-stream",daemon=True)
+            self.thread.start()
+        return self
+
+    def run(self):
+        import requests
+        last_id = None
+        backoff = 1
+        while True:
+            try:
+                headers = {'Accept':'text/event-stream'}
+                if last_id is not None:
+                    headers['Last-Event-ID'] = str(last_id)
+                # the server sends a keepalive every 15s, a longer silence is a dead connection
+                with requests.get(self.url,stream=True,headers=headers,timeout=(5,60)) as response:
+                    response.raise_for_status()
+                    self.connected = True
+                    backoff = 1
+                    event_id = None
+                    data = []
+                    for line in response.iter_lines(decode_unicode=True):
+                        if line is None or line.startswith(':'):
+                            continue
+                        if line == '':
+                            if len(data)>0:
+                                self.apply(json.loads('\n'.join(data)))
+                            if event_id is not None:
+                                last_id = event_id
+                            event_id = None
+                            data = []
+                        elif line.startswith('id:'):
+                            event_id = int(line[3:].strip())
+                        elif line.startswith('data:'):
+                            data.append(line[5:].strip())
+            except Exception as err:
+                if self.logger is not None:
+                    self.logger.warning(f"event stream {self.url}: {err}")
+            self.connected = False
+            time.sleep(backoff)
+            backoff = min(backoff*2,30)
+
+    def apply(self,event):
+        with self.lock:
+            if event['type'] == 'snapshot':
+                self.states = {device:dict(states) for device,states in event['devices'].items() if isinstance(states,dict) and 'error' not in states}
+            elif event['type'] == 'state':
+                self.states.setdefault(event['device'],{})[event['plug']] = event['state']
+            if event['type'] in ('snapshot','state','transition'):
+                self.changes += 1
+            if event['type'] != 'snapshot':
+                self.events.append(event)
+
+    def snapshot(self):
+        """ returns ({device: {plug: state}}, [recent event,...], changes) """
+        with self.lock:
+            return {device:dict(states) for device,states in self.states.items()},list(self.events),self.changes
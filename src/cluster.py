@@ -0,0 +1,220 @@
+import asyncio
+import os
+import socket
+import time
+from drivers import DeviceError
+
+class Cluster():
+    """ Coordinates the API workers of `uvicorn --workers N` through the shared SQLite database.
+
+    One worker holds the `leader` lease row and is the only one that talks to
+    the devices: it runs the startup recovery, the scheduler and every device
+    write.  It publishes the plug states it sees to `state_snapshot`, reading
+    every device each `snapshot_interval` seconds to keep them fresh.
+
+    The other workers serve reads from that snapshot and put writes in the
+    `outbox` table, which the leader drains.  When the leader dies its lease
+    expires after `lease_ttl` seconds and another worker takes over.
+
+    A single worker takes the lease too and wins it right away.  Workers
+    started without `WEB_CONCURRENCY`, or a second service on the same
+    database, then still have only one leader.
+    """
+    lease_name = 'leader'
+    lease_ttl = 10
+    interval = 0.25
+    snapshot_interval = 10
+    call_timeout = 10
+    purge_after = 3600
+
+    def __init__(self,fleet,store,workers=1,actions=None,logger=None,on_elected=None,on_demoted=None):
+        self.fleet = fleet
+        self.store = store
+        self.workers = workers
+        self.actions = actions if actions is not None else {}
+        self.logger = logger
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.holder = f"{socket.gethostname()}:{os.getpid()}"
+        self.leader = False
+        self.listeners = []
+        self.snapshot = {}
+        self.dirty = set()
+        self.refreshed_at = 0
+        self.purged_at = 0
+        self.task = None
+        self.elected_task = None
+        self.refresh_task = None
+        self.running = set()
+        self.wakeup = None
+
+    @classmethod
+    def from_env(cls,fleet,store,**kwargs):
+        # uvicorn reads WEB_CONCURRENCY as the default of --workers
+        return cls(fleet,store,workers=int(os.environ.get('WEB_CONCURRENCY',1)),**kwargs)
+
+    async def join(self):
+        """ first try for the lease, a worker that wins it is the leader before it serves requests """
+        leader = await asyncio.to_thread(self.store.acquire_lease,self.lease_name,self.holder,self.lease_ttl)
+        await self.elect(leader)
+
+    def observe(self,event):
+        """ strip listener on the leader, marks devices whose snapshot changed """
+        if event['type'] == 'state':
+            self.dirty.add(event['device'])
+
+    def states(self):
+        """ {device: {plug: state}} as last published by the leader """
+        return {device:dict(states) for device,(states,_) in self.snapshot.items()}
+
+    async def elect(self,leader):
+        if leader == self.leader:
+            return
+        self.leader = leader
+        if self.logger is not None:
+            self.logger.info(f"{self.holder} is {'the leader' if leader else 'a follower'}")
+        if leader:
+            requeued = await asyncio.to_thread(self.store.requeue_commands)
+            if requeued > 0 and self.logger is not None:
+                self.logger.warning(f"requeued {requeued} commands left running by the previous leader")
+            self.dirty.update(self.fleet.strips)
+            self.refreshed_at = 0
+            if self.on_elected is not None:
+                # runs beside the lease loop, recovery may take longer than the lease
+                self.elected_task = asyncio.create_task(self.on_elected())
+        else:
+            for task in [self.elected_task,self.refresh_task,*self.running]:
+                if task is not None:
+                    task.cancel()
+            self.elected_task = None
+            self.refresh_task = None
+            if self.on_demoted is not None:
+                await self.on_demoted()
+
+    async def run(self):
+        self.wakeup = asyncio.Event()
+        renewed_at = 0
+        while True:
+            try:
+                if time.monotonic()-renewed_at >= self.lease_ttl/3:
+                    leader = await asyncio.to_thread(self.store.acquire_lease,self.lease_name,self.holder,self.lease_ttl)
+                    renewed_at = time.monotonic()
+                    await self.elect(leader)
+                if self.leader:
+                    await self.drain()
+                    await self.publish()
+                else:
+                    await self.follow()
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                if self.logger is not None:
+                    self.logger.error(f"cluster: {err}")
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(),timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def drain(self):
+        commands = await asyncio.to_thread(self.store.claim_commands)
+        # commands run beside the lease loop, those for the same device meet in its command queue and go out as one batch
+        for command in commands:
+            task = asyncio.create_task(self.execute(command))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+        if time.time()-self.purged_at > self.purge_after:
+            self.purged_at = time.time()
+            await asyncio.to_thread(self.store.purge_commands,self.purged_at-self.purge_after)
+
+    async def execute(self,command):
+        try:
+            result = await self.actions[command['action']](command['device'],command['plug'],command['state'])
+            await asyncio.to_thread(self.store.finish_command,command['id'],'done',result=result)
+        except Exception as err:
+            await asyncio.to_thread(self.store.finish_command,command['id'],'failed',error=str(err))
+
+    async def publish(self):
+        if time.monotonic()-self.refreshed_at >= self.snapshot_interval and (self.refresh_task is None or self.refresh_task.done()):
+            # a slow device must not hold up the lease renewal
+            self.refreshed_at = time.monotonic()
+            self.refresh_task = asyncio.create_task(self.fleet.astatus())
+        dirty,self.dirty = self.dirty,set()
+        for device in dirty:
+            strip = self.fleet.strips.get(device)
+            if strip is None:
+                # removed by a config reload
+                continue
+            with strip.state_lock:
+                states = dict(strip.known)
+            await asyncio.to_thread(self.store.put_snapshot,device,states)
+            self.snapshot[device] = (states,time.time())
+
+    async def follow(self):
+        """ reloads the snapshot and passes the plug states that changed to listeners as `state` events """
+        snapshot = await asyncio.to_thread(self.store.get_snapshots)
+        for device,(states,_) in snapshot.items():
+            previous = self.snapshot.get(device,({},None))[0]
+            for plug,state in states.items():
+                if previous.get(plug) != state:
+                    event = {'type':'state','device':device,'at':time.time(),'plug':plug,'state':state,'source':'snapshot'}
+                    for listener in list(self.listeners):
+                        listener(event)
+        self.snapshot = snapshot
+
+    async def call(self,action,device=None,plug=None,state=None):
+        """ has the leader run actions[action](device, plug, state).
+        returns (result, None), or (None, token) when the leader has not finished within `call_timeout` seconds.
+        raises DeviceError when the action failed
+        """
+        command_id = await asyncio.to_thread(self.store.enqueue_command,action,device,plug,state)
+        if self.leader:
+            self.wakeup.set()
+        deadline = time.monotonic()+self.call_timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+            command = await asyncio.to_thread(self.store.get_command,command_id)
+            if command['status'] == 'done':
+                return command['result'],None
+            if command['status'] == 'failed':
+                raise DeviceError(command['error'])
+        return None,f"outbox:{command_id}"
+
+    async def lookup(self,token):
+        """ outcome of a token returned by call(), None when it is unknown """
+        command_id = token.split(':',1)[1]
+        if not command_id.isdigit():
+            return None
+        command = await asyncio.to_thread(self.store.get_command,int(command_id))
+        if command is None:
+            return None
+        status = command['status'] if command['status'] in ('done','failed') else 'pending'
+        return {'status':status,'states':command['result'],'error':command['error']}
+
+    def stats(self):
+        lease = self.store.get_lease(self.lease_name)
+        return {
+            'workers':self.workers,
+            'holder':self.holder,
+            'leader':self.leader,
+            'lease':{'holder':lease[0],'expires_in':lease[1]-time.time()} if lease is not None else None,
+            'snapshot_age':{device:time.time()-updated_at for device,(_,updated_at) in self.snapshot.items()},
+        }
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+        return self.task
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        if self.leader:
+            await self.elect(False)
+            # hand over right away instead of waiting for the lease to expire
+            await asyncio.to_thread(self.store.release_lease,self.lease_name,self.holder)
@@ -0,0 +1,264 @@
+import asyncio
+import collections
+import itertools
+import random
+import time
+from drivers import DeviceError,PlugNotFoundError
+
+class CircuitOpenError(DeviceError):
+    def __init__(self,message,retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class CircuitBreaker():
+    """ Stops talking to a host that keeps failing.
+
+    After `threshold` consecutive failures the circuit opens and requests are
+    rejected without touching the network.  After `reset_timeout` seconds one
+    request is let through: success closes the circuit, failure opens it again.
+    """
+
+    def __init__(self,threshold=5,reset_timeout=60):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if self.probing or self.retry_after() > 0:
+            return 'open'
+        return 'half-open'
+
+    def retry_after(self):
+        if self.opened_at is None:
+            return 0
+        return max(self.opened_at+self.reset_timeout-time.monotonic(),0)
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        if not self.probing and self.retry_after() <= 0:
+            self.probing = True
+            return True
+        return False
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def release(self):
+        """ a probe that ended without an outcome (cancelled) lets the next request probe instead """
+        self.probing = False
+
+    def failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+class Command():
+    def __init__(self,state):
+        self.state = state
+        self.attempts = 0
+        self.futures = []
+
+class CommandQueue():
+    """ Serializes the writes to one device.
+
+    Commands wait in `pending` keyed by plug, a newer command for the same plug
+    replaces an older one that has not been sent (last writer wins) and both
+    callers get the outcome of the newer one.  Everything pending goes out as
+    one batched `set_states` request.  Failed commands are retried with jittered
+    exponential backoff, and the host's circuit breaker fails callers fast while
+    the device is unreachable.  A plug the device does not have fails on its own
+    without a retry, the rest of its batch is sent again.
+
+    The queue runs on the driver loop, `execute()` is awaited through `driver.acall()`.
+    """
+    tokens_kept = 1000
+
+    def __init__(self,name,driver,config=None,logger=None,on_applied=None,on_failed=None,on_rejected=None):
+        config = config if config is not None else {}
+        self.name = name
+        self.driver = driver
+        self.logger = logger
+        self.on_applied = on_applied
+        self.on_failed = on_failed
+        self.on_rejected = on_rejected
+        self.breaker = CircuitBreaker()
+        self.configure(config)
+        self.pending = {}
+        self.task = None
+        self.superseded = None
+        self.tokens = collections.OrderedDict()
+        self.counter = itertools.count(1)
+
+    def configure(self,config):
+        """ applies the command settings of a device config, the breaker keeps its state """
+        self.timeout = float(config.get('command_timeout',5))
+        self.retries = int(config.get('command_retries',3))
+        self.backoff = float(config.get('command_backoff',1))
+        self.breaker.threshold = int(config.get('breaker_threshold',5))
+        self.breaker.reset_timeout = float(config.get('breaker_reset',60))
+
+    def check(self,operation='set_states'):
+        """ raises CircuitOpenError unless the breaker lets a request through, on_rejected(operation) counts it.
+        returns True when the request is the half-open probe, the caller must release() it if it ends without success() or failure()
+        """
+        probing = self.breaker.probing
+        if not self.breaker.allow():
+            retry_after = self.breaker.retry_after()
+            if self.on_rejected is not None:
+                self.on_rejected(operation)
+            raise CircuitOpenError(f"{self.name} circuit is open after {self.breaker.failures} failures, retry in {retry_after:.0f}s",retry_after=retry_after)
+        return self.breaker.probing and not probing
+
+    def submit(self,states):
+        """ queues {plug: state}, returns {plug: future of the state applied} """
+        if self.breaker.state() == 'open':
+            self.check()
+        loop = asyncio.get_running_loop()
+        futures = {}
+        for plug,state in states.items():
+            command = self.pending.get(plug)
+            if command is None:
+                command = self.pending[plug] = Command(state)
+            elif command.attempts > 0:
+                # a newer request gets every retry, and does not wait out the backoff of the one it replaces
+                command.attempts = 0
+                if self.superseded is not None:
+                    self.superseded.set()
+            command.state = state
+            futures[plug] = loop.create_future()
+            command.futures.append(futures[plug])
+        if self.task is None or self.task.done():
+            self.task = loop.create_task(self.run())
+        return futures
+
+    async def execute(self,states,return_exceptions=False):
+        """ queues {plug: state} and waits for the outcome, returns {plug: applied state}.
+        raises DeviceError when the command failed, CircuitOpenError while the circuit is open.
+        with return_exceptions a plug that failed maps to its DeviceError instead
+        """
+        futures = self.submit(states)
+        results = await asyncio.gather(*futures.values(),return_exceptions=return_exceptions)
+        return dict(zip(futures,results))
+
+    async def request(self,states):
+        """ like execute() but waits at most `command_timeout` seconds.
+        a command still retrying by then returns {plug: state, 'pending': token}, lookup(token) reports its outcome
+        """
+        futures = self.submit(states)
+        done,_ = await asyncio.wait(futures.values(),timeout=self.timeout)
+        if len(done) < len(futures):
+            token = f"{self.name}:{next(self.counter)}"
+            self.tokens[token] = (dict(states),futures)
+            while len(self.tokens) > self.tokens_kept:
+                self.tokens.popitem(last=False)
+            return {**states,'pending':token}
+        return {plug:future.result() for plug,future in futures.items()}
+
+    def lookup(self,token):
+        """ returns {'status': 'pending'|'done'|'failed', 'states': {plug: state}, 'error': ...} of a pending token, None when unknown """
+        if token not in self.tokens:
+            return None
+        states,futures = self.tokens[token]
+        if not all(future.done() for future in futures.values()):
+            return {'status':'pending','states':states,'error':None}
+        errors = [str(future.exception()) for future in futures.values() if future.exception() is not None]
+        if len(errors) > 0:
+            return {'status':'failed','states':states,'error':errors[0]}
+        return {'status':'done','states':{plug:future.result() for plug,future in futures.items()},'error':None}
+
+    def resolve(self,command,result=None,error=None):
+        for future in command.futures:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+                # a caller that gave up waiting holds a token, the error is reported through lookup()
+                future.exception()
+            else:
+                future.set_result(result)
+
+    async def run(self):
+        while len(self.pending) > 0:
+            batch,self.pending = self.pending,{}
+            states = {plug:command.state for plug,command in batch.items()}
+            probe = False
+            try:
+                probe = self.check()
+                await self.driver.set_states(states)
+            except asyncio.CancelledError:
+                # the loop is shutting down, nothing is left to send what is queued
+                if probe:
+                    self.breaker.release()
+                error = DeviceError(f"{self.name}: command cancelled")
+                for command in [*batch.values(),*self.pending.values()]:
+                    self.resolve(command,error=error)
+                self.pending = {}
+                raise
+            except PlugNotFoundError as err:
+                # the device answered, only the missing plugs fail, the others go out again
+                if probe:
+                    self.breaker.release()
+                if self.on_failed is not None:
+                    self.on_failed({plug:states[plug] for plug in err.plugs if plug in states},err)
+                for plug,command in batch.items():
+                    if plug in err.plugs:
+                        self.resolve(command,error=err)
+                    elif plug in self.pending:
+                        self.pending[plug].futures[:0] = command.futures
+                    else:
+                        self.pending[plug] = command
+                continue
+            except DeviceError as err:
+                # a request the open circuit rejected never reached the device, on_rejected counted it
+                if not isinstance(err,CircuitOpenError):
+                    self.breaker.failure()
+                    if self.on_failed is not None:
+                        self.on_failed(states,err)
+                retry = []
+                for plug,command in batch.items():
+                    command.attempts += 1
+                    if isinstance(err,CircuitOpenError) or command.attempts > self.retries:
+                        self.resolve(command,error=err)
+                    elif plug in self.pending:
+                        # superseded while in flight, the waiters of this command get the newer outcome
+                        self.pending[plug].futures[:0] = command.futures
+                    else:
+                        self.pending[plug] = command
+                        retry.append(command.attempts)
+                if len(retry) > 0:
+                    delay = self.backoff*2**(max(retry)-1)*random.uniform(0.5,1.5)
+                    if self.logger is not None:
+                        self.logger.warning(f"{self.name}: retrying {','.join(states)} in {delay:.1f}s: {err}")
+                    self.superseded = asyncio.Event()
+                    try:
+                        await asyncio.wait_for(self.superseded.wait(),timeout=delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    self.superseded = None
+                continue
+            except Exception as err:
+                # not a device failure (a missing kasa binary, a driver bug), retrying would not help
+                error = DeviceError(f"{self.name}: {err.__class__.__name__}: {err}")
+                error.__cause__ = err
+                self.breaker.failure()
+                if self.on_failed is not None:
+                    self.on_failed(states,error)
+                for command in batch.values():
+                    self.resolve(command,error=error)
+                continue
+            self.breaker.success()
+            if self.on_applied is not None:
+                self.on_applied(states)
+            for plug,command in batch.items():
+                self.resolve(command,result=command.state)
+
+    def stats(self):
+        return {'circuit':self.breaker.state(),'failures':self.breaker.failures,'retry_after':self.breaker.retry_after(),'pending':len(self.pending)}
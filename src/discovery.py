@@ -0,0 +1,171 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+# Finds the strips on the LAN so configs can name a device by `alias` or `mac` instead of a fixed `host`.
+#   python discovery.py                       # sweep and print what was found, updates the cache
+#   python discovery.py --targets 192.168.0.255,192.168.1.255
+
+def normalize_mac(mac):
+    if mac is None:
+        return None
+    digits = ''.join(c for c in str(mac).lower() if c in '0123456789abcdef')
+    return ':'.join(digits[i:i+2] for i in range(0,len(digits),2))
+
+class Discovery():
+    """ Maps device aliases and MAC addresses to the IP addresses found by UDP broadcast.
+
+    The map is kept in a JSON file, $SMARTHOME_DISCOVERY_CACHE or
+    ~/.cache/campsmith/discovery.json (set it empty to keep the map in memory
+    only), so a restart needs no sweep.  Lookups are dict reads.  A sweep
+    probes every broadcast address in `targets` at once, and only runs when a
+    driver could not reach its device.  Drivers that fail together share one
+    sweep, and sweeps are at least `min_interval` seconds apart.
+    """
+    instances = {}
+    instances_lock = threading.Lock()
+    min_interval = 60
+
+    def __init__(self,cache_path=None,targets=('255.255.255.255',),timeout=5,logger=None):
+        self.cache_path = Path(cache_path) if cache_path else None
+        self.targets = list(targets)
+        self.timeout = timeout
+        self.logger = logger
+        self.devices = {}
+        self.by_alias = {}
+        self.by_mac = {}
+        self.lock = threading.Lock()
+        self.sweep = None
+        self.swept_at = None
+        self.load()
+
+    @classmethod
+    def get(cls,logger=None):
+        """ the process wide discovery for the cache in the environment """
+        default = Path(os.environ.get('XDG_CACHE_HOME',Path.home()/'.cache'))/'campsmith'/'discovery.json'
+        cache_path = os.environ.get('SMARTHOME_DISCOVERY_CACHE',str(default))
+        targets = [target.strip() for target in os.environ.get('SMARTHOME_DISCOVERY_TARGETS','255.255.255.255').split(',') if target.strip()]
+        with cls.instances_lock:
+            if cache_path not in cls.instances:
+                cls.instances[cache_path] = cls(cache_path,targets=targets,logger=logger)
+            return cls.instances[cache_path]
+
+    def load(self):
+        if self.cache_path is None or not self.cache_path.exists():
+            return
+        try:
+            self.index(json.loads(self.cache_path.read_text())['devices'])
+        except Exception as err:
+            if self.logger is not None:
+                self.logger.warning(f"discovery cache {self.cache_path} is not usable: {err}")
+
+    def save(self):
+        if self.cache_path is None:
+            return
+        try:
+            self.cache_path.parent.mkdir(parents=True,exist_ok=True)
+            tmp_path = self.cache_path.with_suffix(f".{os.getpid()}.tmp")
+            with self.lock:
+                tmp_path.write_text(json.dumps({'devices':list(self.devices.values())},indent=2))
+            os.replace(tmp_path,self.cache_path)
+        except OSError as err:
+            if self.logger is not None:
+                self.logger.warning(f"discovery cache {self.cache_path} not written: {err}")
+
+    def index(self,devices):
+        """ adds [{'host':..., 'alias':..., 'mac':..., 'seen_at':...},...], a device that moved replaces its old address """
+        with self.lock:
+            for device in devices:
+                mac = normalize_mac(device.get('mac'))
+                key = mac if mac else device['host']
+                self.devices[key] = {**device,'mac':mac}
+            self.by_alias = {}
+            self.by_mac = {}
+            for device in sorted(self.devices.values(),key=lambda d: d.get('seen_at',0)):
+                if device.get('alias'):
+                    self.by_alias[device['alias']] = device['host']
+                if device.get('mac'):
+                    self.by_mac[device['mac']] = device['host']
+
+    def lookup(self,alias=None,mac=None):
+        """ host of the device with this mac, or else this alias, None when it has not been seen """
+        with self.lock:
+            if mac is not None and normalize_mac(mac) in self.by_mac:
+                return self.by_mac[normalize_mac(mac)]
+            if alias is not None:
+                return self.by_alias.get(alias)
+            return None
+
+    async def probe(self,target,credentials=None):
+        """ one broadcast sweep of target, returns [{'host','alias','mac','seen_at'},...] """
+        from drivers import import_kasa
+        kasa = import_kasa()
+        found = await kasa.Discover.discover(target=target,discovery_timeout=self.timeout,credentials=credentials)
+        async def describe(device):
+            try:
+                if device.alias is None and credentials is not None:
+                    # newer devices only report their alias to an authenticated update
+                    await device.update()
+                return {'host':device.host,'alias':device.alias,'mac':device.mac,'seen_at':time.time()}
+            except Exception as err:
+                if self.logger is not None:
+                    self.logger.debug(f"discovery: {device.host} did not describe itself: {err}")
+                return {'host':device.host,'alias':None,'mac':getattr(device,'mac',None),'seen_at':time.time()}
+            finally:
+                try:
+                    await device.disconnect()
+                except Exception:
+                    pass
+        return await asyncio.gather(*[describe(device) for device in found.values()])
+
+    async def discover(self,credentials=None):
+        """ sweeps every target at once, indexes and saves what answered, returns it """
+        started = time.perf_counter()
+        results = await asyncio.gather(*[self.probe(target,credentials=credentials) for target in self.targets],return_exceptions=True)
+        devices = []
+        for target,result in zip(self.targets,results):
+            if isinstance(result,Exception):
+                if self.logger is not None:
+                    self.logger.warning(f"discovery on {target} failed: {result}")
+                continue
+            devices.extend(result)
+        self.index(devices)
+        await asyncio.to_thread(self.save)
+        if self.logger is not None:
+            self.logger.info(f"discovered {len(devices)} devices on {','.join(self.targets)} in {(time.perf_counter()-started)*1000:.0f}ms")
+        return devices
+
+    async def refresh(self,credentials=None):
+        """ runs a sweep unless one is running, which is awaited instead, or one finished less than `min_interval` seconds ago """
+        if self.sweep is None or self.sweep.done():
+            if self.swept_at is not None and time.monotonic()-self.swept_at < self.min_interval:
+                return False
+            self.swept_at = time.monotonic()
+            self.sweep = asyncio.ensure_future(self.discover(credentials=credentials))
+        await asyncio.shield(self.sweep)
+        return True
+
+    async def resolve(self,alias=None,mac=None,credentials=None):
+        """ sweeps (see refresh) and returns the host now known for the device """
+        await self.refresh(credentials=credentials)
+        return self.lookup(alias=alias,mac=mac)
+
+def main(targets=None,timeout=5,cache=None):
+    import logging
+    logger = logging.getLogger('discovery')
+    logging.basicConfig(level=logging.INFO,format='%(levelname)s: %(message)s')
+    if targets is not None:
+        os.environ['SMARTHOME_DISCOVERY_TARGETS'] = targets if isinstance(targets,str) else ','.join(targets)
+    if cache is not None:
+        os.environ['SMARTHOME_DISCOVERY_CACHE'] = cache
+    discovery = Discovery.get(logger=logger)
+    discovery.timeout = timeout
+    for device in asyncio.run(discovery.discover()):
+        print(f"{device['host']:<16} {device['mac'] or '-':<18} {device['alias'] or '-'}")
+
+if __name__=='__main__':
+    import fire
+    fire.Fire(main)
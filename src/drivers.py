@@ -0,0 +1,313 @@
+import asyncio
+import json
+import os
+import random
+import threading
+from discovery import Discovery
+
+class DeviceError(Exception):
+    pass
+
+class PlugNotFoundError(DeviceError):
+    """ the device answered but has no child with these aliases, retrying will not help """
+    def __init__(self,plugs,host):
+        super().__init__(f"{','.join(plugs)} not found on {host}")
+        self.plugs = list(plugs)
+
+def import_kasa():
+    # python-kasa takes a noticeable part of startup on a Pi, only the kasa driver loads it
+    import kasa
+    import kasa.iot
+    return kasa
+
+class Driver():
+    """ Base class for device backends.
+
+    Driver methods are coroutines.  They run on one background event loop shared
+    by every driver in the process so that device connections outlive a single
+    call.  Synchronous callers use `call()`, coroutines on any other loop await `acall()`.
+    """
+    loop = None
+    loop_thread = None
+    loop_lock = threading.Lock()
+
+    def __init__(self,host,config=None,logger=None):
+        self.host = host
+        self.config = config if config is not None else {}
+        self.logger = logger
+        # a device named by `alias` or `mac` is looked up on the LAN, `host` is then only the first address tried
+        self.alias = self.config.get('alias')
+        self.mac = self.config.get('mac')
+        self.discovery = None
+        if self.alias is not None or self.mac is not None:
+            self.discovery = Discovery.get(logger=logger)
+            if self.host is None:
+                self.host = self.discovery.lookup(alias=self.alias,mac=self.mac)
+
+    @classmethod
+    def get_loop(cls):
+        with Driver.loop_lock:
+            if Driver.loop is None:
+                Driver.loop = asyncio.new_event_loop()
+                Driver.loop_thread = threading.Thread(target=Driver.loop.run_forever,name="smarthome-drivers",daemon=True)
+                Driver.loop_thread.start()
+        return Driver.loop
+
+    def call(self,coro):
+        return asyncio.run_coroutine_threadsafe(coro,self.get_loop()).result()
+
+    async def acall(self,coro):
+        loop = self.get_loop()
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            return await coro
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro,loop))
+
+    def get_credentials(self):
+        return None
+
+    async def rediscover(self):
+        """ looks the device up again after it could not be reached, True when it answers on another address now """
+        if self.discovery is None:
+            return False
+        host = await self.discovery.resolve(alias=self.alias,mac=self.mac,credentials=self.get_credentials())
+        if host is None or host == self.host:
+            return False
+        if self.logger is not None:
+            self.logger.warning(f"{self.alias or self.mac} moved from {self.host} to {host}")
+        self.host = host
+        return True
+
+    async def ensure_host(self):
+        if self.host is None and not await self.rediscover():
+            raise DeviceError(f"{self.alias or self.mac} was not found on the network")
+
+    async def sysinfo(self):
+        """ returns get_sysinfo style dict: {'alias': ..., 'children': [{'id':...,'alias':...,'state':0|1},...]} """
+        raise NotImplementedError
+
+    async def set_state(self,plug,state):
+        raise NotImplementedError
+
+    async def set_states(self,states):
+        """ sets {plug: state} for several plugs, backends that can batch the request override this """
+        await asyncio.gather(*[self.set_state(plug,state) for plug,state in states.items()])
+        return states
+
+    async def emeter(self):
+        """ returns {plug: watts} for plugs with an energy meter, {} when the device has none """
+        return {}
+
+    async def close(self):
+        pass
+
+class CliDriver(Driver):
+    """ Runs the `kasa` command line tool for every request. """
+
+    async def run(self,*args):
+        await self.ensure_host()
+        for attempt in range(2):
+            proc = await asyncio.create_subprocess_exec("kasa","--json","--host",self.host,*args,stdout=asyncio.subprocess.PIPE,stderr=asyncio.subprocess.PIPE)
+            stdout,stderr = await proc.communicate()
+            if proc.returncode == 0:
+                return stdout.decode()
+            # a device found by discovery may have moved, try its new address once
+            if attempt > 0 or not await self.rediscover():
+                raise DeviceError(f"kasa {' '.join(args)} failed on {self.host}: [rc={proc.returncode}]{stderr.decode()}")
+
+    async def sysinfo(self):
+        stdout = await self.run("state")
+        if not stdout:
+            return None
+        strip = json.loads(stdout)
+        if 'system' not in strip:
+            return None
+        return strip['system'].get('get_sysinfo')
+
+    async def set_state(self,plug,state):
+        await self.run("on" if state==1 else "off","--child",plug)
+        return state
+
+class KasaDriver(Driver):
+    """ Keeps one python-kasa connection per host open and reconnects when it drops. """
+
+    def __init__(self,host,config=None,logger=None):
+        super().__init__(host,config=config,logger=logger)
+        self.kasa = import_kasa()
+        self.connection_errors = (self.kasa.KasaException, OSError, asyncio.TimeoutError)
+        self.device = None
+        self.device_config = None
+        self.lock = None
+
+    def get_credentials(self):
+        username = self.config.get('username',os.environ.get('KASA_USERNAME'))
+        password = self.config.get('password',os.environ.get('KASA_PASSWORD'))
+        if username is None or password is None:
+            return None
+        return self.kasa.Credentials(username,password)
+
+    async def connect(self):
+        if self.device is not None:
+            return self.device
+        await self.ensure_host()
+        if self.device_config is not None:
+            # reuse the connection parameters found on first contact, no discovery round needed
+            self.device = await self.kasa.Device.connect(config=self.device_config)
+        else:
+            if self.logger is not None:
+                self.logger.info(f"connecting to {self.host}")
+            device = await self.kasa.Discover.discover_single(self.host,credentials=self.get_credentials(),timeout=self.config.get('device_timeout',5))
+            if device is None:
+                raise DeviceError(f"no device found at {self.host}")
+            await device.update()
+            self.device = device
+            self.device_config = device.config
+        return self.device
+
+    async def disconnect(self):
+        device,self.device = self.device,None
+        if device is not None:
+            try:
+                await device.disconnect()
+            except Exception as err:
+                if self.logger is not None:
+                    self.logger.debug(f"error closing connection to {self.host}: {err}")
+
+    async def request(self,action):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            for attempt in range(3):
+                try:
+                    device = await self.connect()
+                    return await action(device)
+                except self.connection_errors as err:
+                    if self.logger is not None:
+                        self.logger.warning(f"connection to {self.host} failed: {err}")
+                    await self.disconnect()
+                    # a dropped connection is reconnected once, only a failed reconnect looks for the device on the LAN
+                    if attempt == 1 and await self.rediscover():
+                        continue
+                    if attempt > 0:
+                        raise DeviceError(f"{self.host} is not reachable: {err}") from err
+
+    async def rediscover(self):
+        moved = await super().rediscover()
+        if moved:
+            # the saved connection parameters point at the old address
+            self.device_config = None
+        return moved
+
+    async def sysinfo(self):
+        async def query(device):
+            await device.update()
+            children = [{'id':child.device_id,'alias':child.alias,'state':1 if child.is_on else 0} for child in device.children]
+            return {'alias':device.alias,'children':children}
+        return await self.request(query)
+
+    async def set_state(self,plug,state):
+        async def switch(device):
+            for child in device.children:
+                if child.alias == plug:
+                    if state == 1:
+                        await child.turn_on()
+                    else:
+                        await child.turn_off()
+                    return state
+            raise PlugNotFoundError([plug],self.host)
+        return await self.request(switch)
+
+    async def set_states(self,states):
+        async def switch(device):
+            children = {child.alias:child for child in device.children}
+            missing = [plug for plug in states if plug not in children]
+            if len(missing) > 0:
+                raise PlugNotFoundError(missing,self.host)
+            if isinstance(device,self.kasa.iot.IotStrip):
+                # legacy strips accept a relay change for several children in one request
+                for state in set(states.values()):
+                    child_ids = [children[plug].child_id for plug,plug_state in states.items() if plug_state==state]
+                    # the query helper raises on a non-zero err_code, a raw protocol query would not
+                    await device._query_helper("system","set_relay_state",{"state":state},child_ids=child_ids)
+            else:
+                await asyncio.gather(*[children[plug].turn_on() if state==1 else children[plug].turn_off() for plug,state in states.items()])
+            return states
+        return await self.request(switch)
+
+    async def emeter(self):
+        async def query(device):
+            await device.update()
+            energy = self.kasa.Module.Energy
+            return {child.alias:child.modules[energy].current_consumption for child in device.children if energy in child.modules}
+        return await self.request(query)
+
+    async def close(self):
+        await self.disconnect()
+
+class SimulatedDriver(Driver):
+    """ In-memory stand-in for a strip, for benchmarks and development without hardware.
+
+        driver: simulated
+        simulator:
+            latency: 0.05     # seconds per request
+            loss: 0.0         # probability that a request times out
+            children: 6       # child plugs, named after the config plugs first
+            power: 25         # watts a plug draws while on, no energy meter when unset
+
+    State is kept per host, so every driver for the same host sees the same strip.
+    """
+    strips = {}
+
+    def __init__(self,host,config=None,logger=None):
+        super().__init__(host,config=config,logger=logger)
+        if self.host is None:
+            self.host = self.config.get('name')
+        simulator = self.config.get('simulator',{})
+        self.latency = float(simulator.get('latency',0.05))
+        self.loss = float(simulator.get('loss',0.0))
+        aliases = list(self.config.get('plugs',{}))
+        children = int(simulator.get('children',len(aliases)))
+        aliases.extend(f"Plug{i}" for i in range(len(aliases),children))
+        self.strips.setdefault(self.host,{alias:0 for alias in aliases})
+        self.power = simulator.get('power')
+        self.requests = 0
+
+    async def request(self):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        if self.loss > 0 and random.random() < self.loss:
+            raise DeviceError(f"{self.host} is not reachable: simulated packet loss")
+        return self.strips[self.host]
+
+    async def sysinfo(self):
+        strip = await self.request()
+        return {'alias':self.host,'children':[{'id':str(i),'alias':alias,'state':state} for i,(alias,state) in enumerate(strip.items())]}
+
+    async def set_state(self,plug,state):
+        return (await self.set_states({plug:state}))[plug]
+
+    async def set_states(self,states):
+        strip = await self.request()
+        missing = [plug for plug in states if plug not in strip]
+        if len(missing) > 0:
+            raise PlugNotFoundError(missing,self.host)
+        strip.update(states)
+        return states
+
+    async def emeter(self):
+        strip = await self.request()
+        if self.power is None:
+            return {}
+        return {alias:float(self.power)*state for alias,state in strip.items()}
+
+drivers = {
+    'kasa': KasaDriver,
+    'cli': CliDriver,
+    'simulated': SimulatedDriver,
+}
+
+def create_driver(config,logger=None):
+    return drivers[config.get('driver','kasa')](config.get('host'),config=config,logger=logger)
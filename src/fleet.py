@@ -0,0 +1,349 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+import yaml
+from pathlib import Path
+import schedule
+import smartstrip
+from smartstrip import ConfigurationError,UnknownDeviceError,SmartStrip
+
+class ConfigCache():
+    """ Validated device configs, one JSON file per config file.  Schedules are compiled again on load.
+
+    An entry is used while the file's mtime and size are unchanged, or when its
+    content still hashes to the cached sha256.  Anything else (an edited file, an
+    unreadable entry, a new `version`, changed validation or schedule code) reads
+    and validates the YAML again.  A config JSON can not represent as it is
+    (dates, non-string keys) is not cached.
+    The cache lives in $SMARTHOME_CONFIG_CACHE, ~/.cache/campsmith by default.  Set it empty to disable.
+    The directory is kept private to the service user, entries owned by anyone else are ignored.
+    """
+    version = 2
+    code = None
+
+    def __init__(self,cache_dir,logger=None):
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.logger = logger
+
+    @classmethod
+    def from_env(cls,logger=None):
+        default = Path(os.environ.get('XDG_CACHE_HOME',Path.home()/'.cache'))/'campsmith'
+        return cls(os.environ.get('SMARTHOME_CONFIG_CACHE',default),logger=logger)
+
+    @classmethod
+    def code_version(cls):
+        """ hash of the modules that validate configs and compile schedules, an upgrade invalidates every entry """
+        if cls.code is None:
+            digest = hashlib.sha256()
+            for path in (smartstrip.__file__,schedule.__file__,__file__):
+                digest.update(Path(path).read_bytes())
+            cls.code = digest.hexdigest()
+        return cls.code
+
+    def entry_path(self,config_path):
+        return self.cache_dir/f"config-{hashlib.sha256(str(Path(config_path).resolve()).encode()).hexdigest()[:16]}.json"
+
+    def load(self,config_path):
+        """ returns the cached {'max_concurrency':..., 'devices':[(config, schedules),...]} or None """
+        if self.cache_dir is None:
+            return None
+        try:
+            path = self.entry_path(config_path)
+            if path.stat().st_uid != os.getuid():
+                if self.logger is not None:
+                    self.logger.warning(f"config cache {path} is not owned by this user, ignored")
+                return None
+            entry = json.loads(path.read_text())
+            if entry.get('version') != self.version or entry.get('code') != self.code_version():
+                return None
+            stat = config_path.stat()
+            if (entry['mtime_ns'],entry['size']) != (stat.st_mtime_ns,stat.st_size):
+                if hashlib.sha256(config_path.read_bytes()).hexdigest() != entry['sha256']:
+                    return None
+                # touched but not changed
+                entry['mtime_ns'],entry['size'] = stat.st_mtime_ns,stat.st_size
+                self.write(config_path,entry)
+            devices = [(config,SmartStrip.check_config(config,config_path=config_path,validate=False)) for config in entry['devices']]
+            return {**entry,'devices':devices}
+        except FileNotFoundError:
+            return None
+        except Exception as err:
+            if self.logger is not None:
+                self.logger.warning(f"config cache for {config_path} is not usable: {err}")
+            return None
+
+    def save(self,config_path,content,max_concurrency,devices):
+        """ caches the validated configs of [(config, schedules),...] """
+        if self.cache_dir is None:
+            return
+        configs = [config for config,_ in devices]
+        try:
+            if json.loads(json.dumps(configs)) != configs:
+                return
+        except (TypeError,ValueError):
+            return
+        stat = config_path.stat()
+        self.write(config_path,{
+            'version':self.version,
+            'code':self.code_version(),
+            'mtime_ns':stat.st_mtime_ns,
+            'size':stat.st_size,
+            'sha256':hashlib.sha256(content).hexdigest(),
+            'max_concurrency':max_concurrency,
+            'devices':configs,
+        })
+
+    def write(self,config_path,entry):
+        path = self.entry_path(config_path)
+        try:
+            self.cache_dir.mkdir(mode=0o700,parents=True,exist_ok=True)
+            os.chmod(self.cache_dir,0o700)
+            tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+            with open(os.open(tmp_path,os.O_WRONLY|os.O_CREAT|os.O_TRUNC,0o600),'w') as entry_file:
+                json.dump(entry,entry_file)
+            os.replace(tmp_path,path)
+        except OSError as err:
+            if self.logger is not None:
+                self.logger.warning(f"config cache for {config_path} not written: {err}")
+
+class Fleet():
+    """ All devices of the house, loaded from one or more config files.
+
+    A config file holds either a single device or a `devices` list.  Other
+    top level keys of a `devices` file are defaults for every device in it.
+
+        max_concurrency: 4
+        log_path: /var/log/campsmith/home
+        db_path: /var/data/devices.db
+        timezone: "America/Los_Angeles"
+        devices:
+            - name: GardenOutletStrip
+              host: 192.168.0.156
+              type: strip
+              plugs: ...
+            - name: PatioStrip
+              host: 192.168.0.157
+              type: strip
+              plugs: ...
+
+    Calls that touch every device run concurrently, at most `max_concurrency` hosts at a time.
+    """
+    max_concurrency = 4
+
+    def __init__(self,config_paths,logger=None,config_cache=None):
+        self.logger = logger
+        self.config_paths = list(config_paths)
+        self.strips = {}
+        self.listeners = []
+        self.reload_lock = None
+        self.config_cache = config_cache if config_cache is not None else ConfigCache(None)
+        for config_path in config_paths:
+            entry = self.config_cache.load(config_path)
+            if entry is not None:
+                if entry['max_concurrency'] is not None:
+                    self.max_concurrency = entry['max_concurrency']
+                for config,schedules in entry['devices']:
+                    self.add(config_path,config,schedules=schedules)
+                continue
+            content = config_path.read_bytes() if config_path.exists() else None
+            max_concurrency,configs = self.read_config(config_path,content)
+            if max_concurrency is not None:
+                self.max_concurrency = max_concurrency
+            strips = [self.add(config_path,config) for config in configs]
+            self.config_cache.save(config_path,content,max_concurrency,[(strip.config,strip.schedules) for strip in strips])
+        if len(self.strips)<1:
+            raise ConfigurationError(f"no devices configured in {', '.join(str(p) for p in config_paths)}")
+
+    @classmethod
+    def from_env(cls,logger=None):
+        if 'KASA_OUTLET_CONFIG' in os.environ:
+            config_paths = [Path(p) for p in os.environ['KASA_OUTLET_CONFIG'].split(os.pathsep) if p]
+        else:
+            config_paths = [SmartStrip.config_path]
+        return cls(config_paths,logger=logger,config_cache=ConfigCache.from_env(logger=logger))
+
+    def add(self,config_path,config,schedules=None):
+        if config.get('name') in self.strips:
+            raise ConfigurationError(f"device {config['name']} in {config_path} is already defined")
+        strip = self.build(config_path,config,schedules=schedules)
+        self.strips[strip.config['name']] = strip
+        return strip
+
+    def build(self,config_path,config,schedules=None):
+        """ a strip for config with the fleet's listeners, not added to the fleet """
+        strip_logger = self.logger.getChild(config['name']) if self.logger is not None and 'name' in config else self.logger
+        strip = SmartStrip(config_path=config_path,logger=strip_logger,config=config,schedules=schedules)
+        strip.listeners.extend(self.listeners)
+        return strip
+
+    def listen(self,listener):
+        """ adds a listener to every device, devices added by a reload get it too """
+        self.listeners.append(listener)
+        for strip in self.strips.values():
+            strip.listeners.append(listener)
+
+    def read_configs(self):
+        """ reads every config file again, returns (max_concurrency, {device: (config_path, config, schedules)}).
+        files that did not change come from the config cache, devices whose config did not change are not validated again
+        """
+        max_concurrency = None
+        devices = {}
+        for config_path in self.config_paths:
+            entry = self.config_cache.load(config_path)
+            if entry is not None:
+                max_concurrency = entry['max_concurrency'] if entry['max_concurrency'] is not None else max_concurrency
+                loaded = entry['devices']
+            else:
+                content = config_path.read_bytes() if config_path.exists() else None
+                file_concurrency,configs = self.read_config(config_path,content)
+                max_concurrency = file_concurrency if file_concurrency is not None else max_concurrency
+                loaded = []
+                for config in configs:
+                    strip = self.strips.get(config.get('name'))
+                    if strip is not None and strip.config == config:
+                        loaded.append((config,strip.schedules))
+                    else:
+                        loaded.append((config,SmartStrip.check_config(config,config_path=config_path,logger=self.logger)))
+                self.config_cache.save(config_path,content,file_concurrency,loaded)
+            for config,schedules in loaded:
+                if config['name'] in devices:
+                    raise ConfigurationError(f"device {config['name']} in {config_path} is already defined")
+                devices[config['name']] = (config_path,config,schedules)
+        if len(devices)<1:
+            raise ConfigurationError(f"no devices configured in {', '.join(str(p) for p in self.config_paths)}")
+        return max_concurrency,devices
+
+    async def areload(self,time_mark=None):
+        """ applies what changed in the config files without a restart.
+
+        Everything is read and validated before anything changes, an invalid
+        config leaves the running one in place and raises ConfigurationError.
+        A device whose connection settings changed is rebuilt, any other change
+        is swapped into the running strip and only the plugs whose schedule or
+        default changed are rebased to time_mark and set on the device.  Without
+        a time_mark queues and devices are not touched, only the config.
+        Returns {device: {'action': 'added'|'removed'|'rebuilt'|'updated', 'plugs': [plug,...], 'result': ...}} of the devices that changed.
+        """
+        if self.reload_lock is None:
+            self.reload_lock = asyncio.Lock()
+        async with self.reload_lock:
+            max_concurrency,devices = await asyncio.to_thread(self.read_configs)
+            changes = {}
+            for name in [name for name in self.strips if name not in devices]:
+                strip = self.strips.pop(name)
+                changes[name] = {'action':'removed','plugs':list(strip.config['plugs'])}
+                await asyncio.to_thread(strip.close)
+            for name,(config_path,config,schedules) in devices.items():
+                strip = self.strips.get(name)
+                if strip is not None and strip.config == config:
+                    continue
+                if strip is None or any(strip.config.get(key) != config.get(key) for key in SmartStrip.connection_keys):
+                    changes[name] = {'action':'added' if strip is None else 'rebuilt','plugs':list(config['plugs'])}
+                    # the new strip replaces the old one in one assignment, requests never find the device missing
+                    old,strip = strip,await asyncio.to_thread(self.build,config_path,config,schedules)
+                    self.strips[name] = strip
+                    if old is not None:
+                        await asyncio.to_thread(old.close)
+                    if time_mark is not None:
+                        changes[name]['result'] = await strip.arecover(time_mark)
+                    continue
+                changes[name] = {'action':'updated','plugs':strip.diff_plugs(config,schedules)}
+                if time_mark is not None:
+                    changes[name]['result'] = await strip.areload(config,schedules,time_mark)
+                else:
+                    await asyncio.to_thread(strip.reload,config,schedules)
+            if max_concurrency is not None:
+                self.max_concurrency = max_concurrency
+            if self.logger is not None and len(changes)>0:
+                summary = ', '.join(f"{name} {change['action']}" for name,change in changes.items())
+                self.logger.info(f"config reloaded: {summary}")
+            return changes
+
+    @staticmethod
+    def read_config(config_path,content=None):
+        """ returns (max_concurrency or None, [device config,...]) """
+        if content is None:
+            raise ConfigurationError(f"Configuration Missing. config_path={config_path.resolve()} ")
+        config = yaml.safe_load(content)
+        if config is None:
+            raise ConfigurationError(f"Invalid configuration, config is None")
+        max_concurrency = int(config['max_concurrency']) if 'max_concurrency' in config else None
+        if 'devices' not in config:
+            return max_concurrency,[config]
+        defaults = {key:value for key,value in config.items() if key not in ('devices','max_concurrency')}
+        return max_concurrency,[{**defaults,**device} for device in config['devices']]
+
+    def get(self,device):
+        if device not in self.strips:
+            raise UnknownDeviceError(f"{device} not in config")
+        return self.strips[device]
+
+    def resolve(self,plug_path):
+        """ maps `device/plug` or a plug name that is unique in the fleet to (strip, plug) """
+        if '/' in plug_path:
+            device,plug = plug_path.split('/',1)
+            return self.get(device),plug
+        matches = [strip for strip in self.strips.values() if plug_path in strip.config['plugs']]
+        if len(matches)==1:
+            return matches[0],plug_path
+        if len(matches)>1:
+            raise UnknownDeviceError(f"{plug_path} is defined on several devices, use device/plug")
+        if len(self.strips)==1:
+            return next(iter(self.strips.values())),plug_path
+        raise UnknownDeviceError(f"{plug_path} not in config")
+
+    async def gather(self,call,devices=None):
+        """ runs call(strip) for every device (or `devices`), returns {device: result}.  a failing device reports {'error': ...} """
+        strips = self.strips if devices is None else {name:self.get(name) for name in devices}
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        async def run(name,strip):
+            async with semaphore:
+                try:
+                    return name,await call(strip)
+                except Exception as err:
+                    if self.logger is not None:
+                        self.logger.error(f"{name}: {err}")
+                    return name,{'error':str(err)}
+        return dict(await asyncio.gather(*[run(name,strip) for name,strip in strips.items()]))
+
+    async def astatus(self):
+        return await self.gather(lambda strip: strip.astatus())
+
+    async def ahandle_all(self,time_mark):
+        return await self.gather(lambda strip: strip.ahandle_all(time_mark))
+
+    async def arecover(self,time_mark):
+        """ brings every device to its intended state in one parallel pass, run once at startup.
+        returns {'devices': {device: result}, 'changed': plugs corrected, 'errors': failed devices and plugs, 'elapsed_ms': ...}
+        """
+        started = time.perf_counter()
+        devices = await self.gather(lambda strip: strip.arecover(time_mark))
+        changed = 0
+        errors = 0
+        for result in devices.values():
+            if 'error' in result:
+                errors += 1
+                continue
+            changed += sum(1 for plug in result['plugs'].values() if plug['changed'])
+            errors += sum(1 for plug in result['plugs'].values() if plug['error'] is not None)
+        elapsed_ms = round((time.perf_counter()-started)*1000,3)
+        if self.logger is not None:
+            self.logger.info(f"recovered {len(devices)} devices in {elapsed_ms}ms, {changed} plugs corrected, {errors} errors")
+        return {'devices':devices,'changed':changed,'errors':errors,'elapsed_ms':elapsed_ms}
+
+    async def alookup_command(self,token):
+        """ outcome of a pending command token, `{device}:{n}` """
+        device = token.rsplit(':',1)[0]
+        return await self.get(device).alookup_command(token)
+
+    def command_stats(self):
+        return {name:strip.commands.stats() for name,strip in self.strips.items()}
+
+    def cache_stats(self):
+        return {name:strip.cache_stats() for name,strip in self.strips.items()}
+
+    def close(self):
+        for strip in self.strips.values():
+            strip.close()
@@ -0,0 +1,234 @@
+import asyncio
+import collections
+import functools
+import os
+import sys
+import threading
+import time
+
+class Metric():
+    type = None
+
+    def __init__(self,name,help,labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self,labels):
+        return tuple(str(labels.get(label,'')) for label in self.labels)
+
+    def format_labels(self,key,extra=None):
+        pairs = list(zip(self.labels,key))
+        if extra is not None:
+            pairs.append(extra)
+        if len(pairs)<1:
+            return ''
+        escaped = [(name,value.replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')) for name,value in pairs]
+        return '{'+','.join(f'{name}="{value}"' for name,value in escaped)+'}'
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}",f"# TYPE {self.name} {self.type}"]
+        with self.lock:
+            for key,value in sorted(self.values.items()):
+                lines.extend(self.render_value(key,value))
+        return lines
+
+    def render_value(self,key,value):
+        return [f"{self.name}{self.format_labels(key)} {value}"]
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self,amount=1,**labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key,0)+amount
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self,value,**labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def replace(self,values):
+        """ replaces every series, values is {label tuple: value} """
+        with self.lock:
+            self.values = dict(values)
+
+class Histogram(Metric):
+    type = 'histogram'
+    default_buckets = (0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30)
+
+    def __init__(self,name,help,labels=(),buckets=None):
+        super().__init__(name,help,labels)
+        self.buckets = tuple(buckets) if buckets is not None else self.default_buckets
+
+    def observe(self,value,**labels):
+        key = self.key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0]*len(self.buckets),0.0,0]
+            series = self.values[key]
+            for i,bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render_value(self,key,value):
+        counts,total,count = value
+        lines = [f"{self.name}_bucket{self.format_labels(key,('le',str(bound)))} {bucket_count}" for bound,bucket_count in zip(self.buckets,counts)]
+        lines.append(f"{self.name}_bucket{self.format_labels(key,('le','+Inf'))} {count}")
+        lines.append(f"{self.name}_sum{self.format_labels(key)} {total}")
+        lines.append(f"{self.name}_count{self.format_labels(key)} {count}")
+        return lines
+
+class Registry():
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self,metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines)+'\n'
+
+registry = Registry()
+operation_seconds = registry.register(Histogram("smarthome_operation_seconds","Latency of SmartStrip operations",labels=("device","operation")))
+device_errors = registry.register(Counter("smarthome_device_errors_total","Failed device requests",labels=("device","operation")))
+circuit_rejections = registry.register(Counter("smarthome_circuit_rejections_total","Requests an open circuit breaker rejected without touching the device",labels=("device","operation")))
+log_seconds = registry.register(Histogram("smarthome_log_seconds","Time spent in log handlers",labels=("handler",)))
+queue_depth = registry.register(Gauge("smarthome_queue_depth","Pending events per plug",labels=("device_key",)))
+circuit_open = registry.register(Gauge("smarthome_circuit_open","1 while a device's circuit breaker rejects requests",labels=("device",)))
+state_cache = registry.register(Gauge("smarthome_state_cache","State cache counters",labels=("device","result")))
+scheduler_overdue = registry.register(Gauge("smarthome_scheduler_overdue_seconds","How long the earliest pending transition is past due"))
+startup_seconds = registry.register(Gauge("smarthome_startup_seconds","Seconds from process start to each startup phase",labels=("phase",)))
+scheduler_lag = registry.register(Histogram("smarthome_scheduler_lag_seconds","Delay between a transition's event_at and when it was handled",buckets=(0.01,0.05,0.1,0.25,0.5,1,2.5,5,10,30,60,300)))
+
+def timed(operation):
+    """ records the latency of a SmartStrip method, sync or async, under its device name """
+    def decorator(method):
+        if asyncio.iscoroutinefunction(method):
+            @functools.wraps(method)
+            async def async_wrapper(self,*args,**kwargs):
+                started = time.perf_counter()
+                try:
+                    return await method(self,*args,**kwargs)
+                finally:
+                    operation_seconds.observe(time.perf_counter()-started,device=self.config['name'],operation=operation)
+            return async_wrapper
+        @functools.wraps(method)
+        def wrapper(self,*args,**kwargs):
+            started = time.perf_counter()
+            try:
+                return method(self,*args,**kwargs)
+            finally:
+                operation_seconds.observe(time.perf_counter()-started,device=self.config['name'],operation=operation)
+        return wrapper
+    return decorator
+
+def instrument_logger(logger):
+    """ times every handler attached to logger """
+    for handler in logger.handlers:
+        if getattr(handler,'instrumented',False):
+            continue
+        handle = handler.handle
+        name = type(handler).__name__
+        def timed_handle(record,handle=handle,name=name):
+            started = time.perf_counter()
+            try:
+                return handle(record)
+            finally:
+                log_seconds.observe(time.perf_counter()-started,handler=name)
+        handler.handle = timed_handle
+        handler.instrumented = True
+
+def process_started_at():
+    """ epoch seconds the process started, None where /proc is not available """
+    try:
+        with open('/proc/self/stat') as stat_file:
+            # fields after the command name, starttime is field 22 of stat
+            start_ticks = int(stat_file.read().rsplit(')',1)[1].split()[19])
+        with open('/proc/uptime') as uptime_file:
+            uptime = float(uptime_file.read().split()[0])
+        return time.time()-(uptime-start_ticks/os.sysconf('SC_CLK_TCK'))
+    except (OSError,ValueError,IndexError):
+        return None
+
+class StartupTimer():
+    """ Time from process start to each startup phase, the first reconcile being the one that matters after a power outage. """
+
+    def __init__(self):
+        self.started_at = process_started_at()
+        if self.started_at is None:
+            self.started_at = time.time()
+        self.phases = {}
+
+    def mark(self,phase):
+        self.phases[phase] = time.time()-self.started_at
+        startup_seconds.set(self.phases[phase],phase=phase)
+        return self.phases[phase]
+
+    def report(self):
+        return {'process_started_at':self.started_at,'phases':dict(self.phases)}
+
+startup = StartupTimer()
+
+class SamplingProfiler():
+    """ Samples the stacks of every thread at a fixed interval while enabled.
+
+    Results are collapsed stacks (`frame;frame;frame count`), the input format of flamegraph tools.
+    """
+    max_depth = 64
+
+    def __init__(self):
+        self.samples = collections.Counter()
+        self.thread = None
+        self.running = threading.Event()
+        self.interval = 0.005
+        self.started_at = None
+
+    def start(self,interval=None):
+        if interval is not None:
+            self.interval = interval
+        if self.thread is not None:
+            return
+        self.samples.clear()
+        self.started_at = time.time()
+        self.running.set()
+        self.thread = threading.Thread(target=self.run,name="smarthome-profiler",daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running.clear()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        own = threading.get_ident()
+        while self.running.is_set():
+            for thread_id,frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    stack.append(f"{frame.f_code.co_name} ({frame.f_code.co_filename.rsplit('/',1)[-1]}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self.samples[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def status(self):
+        return {'enabled':self.thread is not None,'interval':self.interval,'started_at':self.started_at,'samples':sum(self.samples.values())}
+
+    def collapsed(self):
+        return '\n'.join(f"{stack} {count}" for stack,count in self.samples.most_common())+'\n'
+
+profiler = SamplingProfiler()
@@ -0,0 +1,104 @@
+import bisect
+from dataclasses import dataclass
+from datetime import datetime,timedelta
+from zoneinfo import ZoneInfo,ZoneInfoNotFoundError
+
+class ScheduleError(ValueError):
+    pass
+
+def parse_duration(time_span):
+    # time_span format is 00:15:00 interpreted as hours:minutes:seconds
+    # convert time span into seconds
+    time_parts = [int(p) for p in str(time_span).split(':')]
+    if len(time_parts) !=3:
+        raise ScheduleError(f"time_span is not valid.  Expected format `HH:MM:SS` got {time_span}")
+    return int(time_parts[0]*60*60)+int(time_parts[1]*60)+time_parts[2]
+
+@dataclass(frozen=True)
+class RepeatingSchedule():
+    """ On for `cycle_on` seconds, off for `cycle_off` seconds, forever.
+
+    The cycle has no fixed phase, it is anchored by `since=(state, at)`: the
+    state the plug entered at epoch `at`.  Without an anchor the cycle starts
+    with an on phase at epoch 0.
+    """
+    cycle_on: int
+    cycle_off: int
+
+    def duration(self,state):
+        return self.cycle_on if state == 1 else self.cycle_off
+
+    def locate(self,t,since):
+        state,at = since if since is not None else (1,0)
+        period = self.cycle_on+self.cycle_off
+        # start of the cycle that contains t, cycles begin with `state`
+        cycle_at = at+((t-at)//period)*period if period > 0 else at
+        if t < cycle_at+self.duration(state):
+            return state,cycle_at+self.duration(state)
+        return 1-state,cycle_at+period
+
+    def state_at(self,t,since=None):
+        return self.locate(t,since)[0]
+
+    def next_transition(self,t,since=None):
+        """ returns (state, at): the state the plug enters next and when """
+        state,at = self.locate(t,since)
+        return 1-state,at
+
+@dataclass(frozen=True)
+class DailySchedule():
+    """ On inside the daily `times` windows, off outside, in the configured timezone.
+
+    Windows are kept as sorted second-of-day arrays so lookups are a bisect.
+    """
+    timezone: ZoneInfo
+    starts: tuple
+    ends: tuple
+
+    def locate(self,t):
+        local = datetime.fromtimestamp(t,self.timezone)
+        second = local.hour*3600+local.minute*60+local.second+local.microsecond/1000000
+        i = bisect.bisect_right(self.starts,second)-1
+        return local,second,i
+
+    def at(self,day,second):
+        midnight = datetime(day.year,day.month,day.day,tzinfo=self.timezone)
+        return (midnight+timedelta(seconds=second)).timestamp()
+
+    def state_at(self,t,since=None):
+        _,second,i = self.locate(t)
+        return 1 if i >= 0 and second < self.ends[i] else 0
+
+    def next_transition(self,t,since=None):
+        """ returns (state, at): the state the plug enters next and when """
+        local,second,i = self.locate(t)
+        if i >= 0 and second < self.ends[i]:
+            return 0,self.at(local.date(),self.ends[i])
+        if i+1 < len(self.starts):
+            return 1,self.at(local.date(),self.starts[i+1])
+        return 1,self.at(local.date()+timedelta(days=1),self.starts[0])
+
+def get_timezone(name):
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError,ValueError) as err:
+        raise ScheduleError(f"timezone {name} is not valid") from err
+
+def compile_schedule(schedule,timezone,logger=None):
+    """ compiles a plug `schedule` config into an immutable schedule object """
+    if schedule['type'] == 'repeating':
+        return RepeatingSchedule(parse_duration(schedule['cycle_on']),parse_duration(schedule['cycle_off']))
+    if schedule['type'] == 'daily':
+        windows = sorted((parse_duration(time_def['cycle_on']),parse_duration(time_def['cycle_off'])) for time_def in schedule['times'])
+        starts = []
+        ends = []
+        for start,end in windows:
+            if len(ends)>0 and start < ends[-1]:
+                # an entry that overlaps a previous entry is ignored
+                if logger is not None:
+                    logger.warning(f"daily schedule window {start}-{end}s overlaps the previous window, ignored")
+                continue
+            starts.append(start)
+            ends.append(end)
+        return DailySchedule(get_timezone(timezone),tuple(starts),tuple(ends))
+    raise ScheduleError(f"schedule type {schedule['type']} is not supported")
@@ -0,0 +1,174 @@
+import asyncio
+import heapq
+import time
+import metrics
+
+class Scheduler():
+    """ Fires scheduled plug transitions when they are due.
+
+    Keeps one min-heap of (event_at, device, plug) for the whole fleet, built
+    from the `events` queue, and sleeps until the earliest entry is due.  The
+    heap is rebuilt from SQLite on start so pending transitions survive a restart.
+    Each device due is fired in its own task, at most `max_concurrency` at a time.
+    """
+    retry_interval = 30
+
+    def __init__(self,fleet,logger=None):
+        self.fleet = fleet
+        self.logger = logger
+        self.heap = []
+        self.due = {}
+        self.wakeup = None
+        self.task = None
+        self.firing = set()
+        self.limit = None
+        self.listeners = []
+
+    def push(self,device,plug,event_at):
+        # entries are never removed from the heap, `due` holds the live event_at per plug
+        self.due[(device,plug)] = event_at
+        heapq.heappush(self.heap,(event_at,device,plug))
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def read(self):
+        """ [(device, plug, event_at),...] of every scheduled plug from SQLite, runs in a thread and leaves the heap alone """
+        entries = []
+        now = time.time()
+        for device,strip in list(self.fleet.strips.items()):
+            next_events = strip.get_next_events()
+            for plug in strip.get_scheduled_plugs():
+                # plugs that were never handled have no queued event, handle them right away
+                entries.append((device,plug,next_events.get(plug,now)))
+        return entries
+
+    async def load(self):
+        """ rebuilds the heap, the heap and the wakeup event are only touched on the loop """
+        entries = await asyncio.to_thread(self.read)
+        self.heap = []
+        self.due = {}
+        for device,plug,event_at in entries:
+            self.push(device,plug,event_at)
+        if self.logger is not None:
+            self.logger.info(f"scheduler loaded {len(self.due)} plugs")
+
+    async def reschedule(self,device,*plugs):
+        """ re-reads the next event of plugs after they were handled outside of the scheduler """
+        strip = self.fleet.get(device)
+        scheduled = strip.get_scheduled_plugs()
+        plugs = [plug for plug in plugs if plug in scheduled]
+        if len(plugs)<1:
+            return
+        next_events = await asyncio.to_thread(strip.get_next_events)
+        for plug in plugs:
+            if plug in next_events:
+                self.push(device,plug,next_events[plug])
+
+    def forget(self,device,*plugs):
+        """ drops plugs, or every plug of a device, that are no longer scheduled """
+        for key in [key for key in self.due if key[0] == device and (len(plugs)<1 or key[1] in plugs)]:
+            del self.due[key]
+
+    def overdue(self):
+        now = time.time()
+        return max([now-event_at for event_at in self.due.values() if event_at < now],default=0)
+
+    def upcoming(self):
+        return sorted(({'device':device,'plug':plug,'event_at':event_at} for (device,plug),event_at in self.due.items()),key=lambda e: e['event_at'])
+
+    def dispatch(self,due,event_at):
+        """ fires {device: [plug,...]} with one task per device, an unreachable device does not hold back the others """
+        for device,plugs in due.items():
+            task = asyncio.create_task(self.fire(device,plugs,event_at))
+            self.firing.add(task)
+            task.add_done_callback(self.firing.discard)
+
+    async def fire(self,device,plugs,event_at):
+        """ reconciles the due plugs of one device in one batch, failed plugs are retried after `retry_interval` """
+        time_mark = max(int(time.time()),int(event_at))
+        metrics.scheduler_lag.observe(max(time.time()-event_at,0))
+        try:
+            async with self.limit:
+                result = (await self.fleet.gather(lambda strip: strip.ahandle_all(time_mark,plugs=plugs),devices=[device]))[device]
+            if 'error' in result:
+                failed = plugs
+            else:
+                failed = [plug for plug,plug_result in result['plugs'].items() if plug_result['error'] is not None]
+            self.notify(device,plugs,result,event_at)
+            await self.reschedule(device,*[plug for plug in plugs if plug not in failed])
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            # removed by a reload while due, or a listener failed
+            if self.logger is not None:
+                self.logger.error(f"scheduler: {device}: {err}")
+            failed = plugs if device in self.fleet.strips else []
+        if len(failed)>0:
+            if self.logger is not None:
+                self.logger.error(f"{device}: retrying {','.join(failed)} in {self.retry_interval}s")
+            for plug in failed:
+                self.push(device,plug,time.time()+self.retry_interval)
+
+    def notify(self,device,plugs,result,event_at):
+        """ tells listeners about every transition fired, {'type': 'transition', ...} """
+        for plug in plugs:
+            plug_result = result['plugs'].get(plug,{}) if 'plugs' in result else {'error':result.get('error')}
+            event = {'type':'transition','device':device,'plug':plug,'at':time.time(),'due_at':event_at,
+                'state':plug_result.get('state'),'changed':plug_result.get('changed',False),'error':plug_result.get('error')}
+            for listener in list(self.listeners):
+                listener(event)
+
+    async def run(self):
+        self.wakeup = asyncio.Event()
+        self.limit = asyncio.Semaphore(self.fleet.max_concurrency)
+        loaded = False
+        while True:
+            try:
+                if not loaded:
+                    await self.load()
+                    loaded = True
+                while self.heap and self.due.get(self.heap[0][1:]) != self.heap[0][0]:
+                    heapq.heappop(self.heap)
+                delay = self.heap[0][0]-time.time() if self.heap else None
+                if delay is None or delay > 0:
+                    self.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(),timeout=delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                # every plug that is due now is reconciled in one batch per device
+                now = time.time()
+                due = {}
+                event_at = self.heap[0][0]
+                while self.heap and self.heap[0][0] <= now:
+                    due_at,device,plug = heapq.heappop(self.heap)
+                    if self.due.get((device,plug)) == due_at:
+                        del self.due[(device,plug)]
+                        due.setdefault(device,[]).append(plug)
+                if self.logger is not None:
+                    self.logger.debug(f"scheduler firing {due} due @ {event_at}")
+                self.dispatch(due,event_at)
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                if self.logger is not None:
+                    self.logger.error(f"scheduler: {err}")
+                await asyncio.sleep(1)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+        return self.task
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        for task in list(self.firing):
+            task.cancel()
+        await asyncio.gather(*self.firing,return_exceptions=True)
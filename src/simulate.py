@@ -0,0 +1,177 @@
+import json
+import time
+import numpy as np
+from datetime import datetime,timedelta
+from pathlib import Path
+from schedule import DailySchedule,RepeatingSchedule,get_timezone
+from fleet import Fleet
+from smartstrip import ConfigurationError,SmartStrip
+
+# What-if runs of the plug schedules, no device or database is touched.
+#   python simulate.py conf/campsmith-devices.yml --start 2026-01-01 --end 2027-01-01
+#   python simulate.py conf/campsmith-devices.yml --days 90 --daily
+# Start and end are epoch seconds or ISO dates, dates without a timezone are in the timezone of the first device.
+
+def compact(times,states):
+    """ drops transitions that a later one at the same time replaces and those that do not change the state """
+    keep = np.append(times[1:] != times[:-1],True)
+    times,states = times[keep],states[keep]
+    keep = np.concatenate(([True],states[1:] != states[:-1]))
+    return times[keep],states[keep]
+
+def repeating_timeline(schedule,since,start,end):
+    state,at = since
+    period = schedule.cycle_on+schedule.cycle_off
+    initial = schedule.state_at(start,since=since)
+    if period == 0:
+        return np.array([start],dtype=np.float64),np.array([initial],dtype=np.int8)
+    # cycles from the one that contains start, each begins by entering `state`
+    first = at+((start-at)//period)*period
+    cycles = first+period*np.arange(int((end-first)//period)+1,dtype=np.float64)
+    times = np.stack([cycles,cycles+schedule.duration(state)],axis=1).ravel()
+    states = np.tile(np.array([state,1-state],dtype=np.int8),len(cycles))
+    inside = (times > start) & (times < end)
+    return compact(np.concatenate(([start],times[inside])),np.concatenate(([initial],states[inside])))
+
+def local_midnights(timezone,first,last):
+    """ epoch of local midnight for every date from first to last """
+    days = [first+timedelta(days=i) for i in range((last-first).days+1)]
+    return days,np.array([datetime(day.year,day.month,day.day,tzinfo=timezone).timestamp() for day in days])
+
+def daily_timeline(schedule,start,end):
+    first = datetime.fromtimestamp(start,schedule.timezone).date()
+    last = datetime.fromtimestamp(end,schedule.timezone).date()
+    days,midnights = local_midnights(schedule.timezone,first,last+timedelta(days=1))
+    windows = np.stack([np.array(schedule.starts,dtype=np.float64),np.array(schedule.ends,dtype=np.float64)],axis=1).ravel()
+    times = (midnights[:-1,None]+windows[None,:])
+    # DST days are not 24h long, their window times follow the wall clock like DailySchedule.at()
+    for i in np.flatnonzero(np.diff(midnights) != 86400):
+        times[i] = [schedule.at(days[i],second) for second in windows]
+    times = times.ravel()
+    states = np.tile(np.array([1,0],dtype=np.int8),len(schedule.starts)*len(days[:-1]))
+    inside = (times > start) & (times < end)
+    return compact(np.concatenate(([start],times[inside])),np.concatenate(([schedule.state_at(start)],states[inside])))
+
+def timeline(config,plug,schedule,start,end):
+    """ (times, states): the plug enters states[i] at times[i], times[0] is start """
+    default = 1 if config['plugs'][plug].get('default')=='on' else 0
+    if isinstance(schedule,RepeatingSchedule):
+        # a plug without history starts its cycle in its default state, as SmartStrip.rebase_plug() does
+        return repeating_timeline(schedule,(default,start),start,end)
+    if isinstance(schedule,DailySchedule):
+        return daily_timeline(schedule,start,end)
+    return np.array([start],dtype=np.float64),np.array([default],dtype=np.int8)
+
+def on_seconds(times,states,points):
+    """ seconds on from times[0] up to each of points """
+    elapsed = np.concatenate(([0],np.cumsum(states[:-1]*np.diff(times))))
+    i = np.searchsorted(times,points,side='right')-1
+    return elapsed[i]+states[i]*(points-times[i])
+
+def spread(values):
+    return {'mean':float(np.mean(values)),'min':float(np.min(values)),'max':float(np.max(values))} if len(values)>0 else None
+
+def simulate(devices,start,end,daily=False):
+    """ runs {device: (config, schedules)} from start to end (epoch seconds).
+
+    Returns per plug the hours on and the on/off cycles in total and per local
+    day, and across all plugs the time two or more are on at once, the most
+    on together and the overlap of every pair.  Days are the local days of the
+    first device clipped to the range.
+    """
+    started = time.perf_counter()
+    if end <= start:
+        raise ValueError(f"end {end} must be after start {start}")
+    timezone = get_timezone(next(iter(devices.values()))[0]['timezone'])
+    first = datetime.fromtimestamp(start,timezone).date()
+    last = datetime.fromtimestamp(end,timezone).date()
+    days,midnights = local_midnights(timezone,first,last+timedelta(days=1))
+    bounds = np.clip(midnights,start,end)
+    keep = np.concatenate((np.diff(bounds) > 0,[False]))
+    days = [day for day,kept in zip(days,keep) if kept]
+    bounds = np.append(bounds[keep],end)
+    plugs = {}
+    timelines = []
+    for name,(config,schedules) in devices.items():
+        for plug in config['plugs']:
+            schedule = schedules.get(plug)
+            times,states = timeline(config,plug,schedule,start,end)
+            on_per_day = np.diff(on_seconds(times,states,bounds))
+            cycles = times[1:][(states[1:]==1) & (states[:-1]==0)]
+            cycles_per_day = np.diff(np.searchsorted(cycles,bounds,side='left'))
+            result = {
+                'schedule':config['plugs'][plug]['schedule']['type'] if schedule is not None else None,
+                'on_hours':float(on_per_day.sum()/3600),
+                'on_hours_per_day':spread(on_per_day/3600),
+                'cycles':int(len(cycles)),
+                'cycles_per_day':spread(cycles_per_day),
+                'switches':int(len(times)-1),
+            }
+            if daily:
+                result['daily'] = [{'date':str(day),'on_hours':float(on/3600),'cycles':int(count)} for day,on,count in zip(days,on_per_day,cycles_per_day)]
+            plugs[f"{name}/{plug}"] = result
+            timelines.append((times,states))
+    # every plug's state between consecutive transitions of the whole fleet
+    times = np.unique(np.concatenate([t for t,_ in timelines]))
+    matrix = np.stack([s[np.searchsorted(t,times,side='right')-1] for t,s in timelines]).astype(np.float64)
+    durations = np.diff(np.append(times,end))
+    together = matrix.sum(axis=0)
+    pairs = (matrix*durations)@matrix.T
+    names = list(plugs)
+    overlap = {
+        'hours':float(durations[together >= 2].sum()/3600),
+        'max_on':int(together.max()),
+        'pairs':{f"{names[i]} & {names[j]}":float(pairs[i,j]/3600) for i in range(len(names)) for j in range(i+1,len(names)) if pairs[i,j] > 0},
+    }
+    if daily:
+        overlap['daily'] = [{'date':str(day),'hours':float(hours/3600)} for day,hours in zip(days,np.diff(on_seconds(times,(together >= 2).astype(np.int8),bounds)))]
+    return {
+        'start':start,
+        'end':end,
+        'days':len(days),
+        'plugs':plugs,
+        'overlap':overlap,
+        'elapsed_ms':(time.perf_counter()-started)*1000,
+    }
+
+def load_devices(config_path,content=None):
+    """ reads and validates a config file, or its YAML `content`, returns {device: (config, schedules)} """
+    config_path = Path(config_path)
+    if content is None:
+        content = config_path.read_bytes() if config_path.exists() else None
+    _,configs = Fleet.read_config(config_path,content)
+    return {config['name']:(config,SmartStrip.check_config(config,config_path=config_path)) for config in configs}
+
+def parse_time(value,timezone):
+    """ epoch seconds from a number or an ISO date or datetime, naive ones in timezone """
+    if isinstance(value,(int,float)):
+        return float(value)
+    moment = datetime.fromisoformat(str(value))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone)
+    return moment.timestamp()
+
+def time_range(devices,start=None,end=None,days=None):
+    """ (start, end) epoch seconds, from now and `days` (default 30) long when not given """
+    timezone = get_timezone(next(iter(devices.values()))[0]['timezone'])
+    start = parse_time(start,timezone) if start is not None else float(int(time.time()))
+    if end is None:
+        end = start+86400*(days if days is not None else 30)
+    return start,parse_time(end,timezone)
+
+def main(config_path,start=None,end=None,days=None,daily=False,output=None):
+    try:
+        devices = load_devices(config_path)
+    except ConfigurationError as err:
+        raise SystemExit(str(err))
+    start,end = time_range(devices,start,end,days)
+    result = json.dumps(simulate(devices,start,end,daily=daily),indent=2)
+    if output is not None:
+        Path(output).write_text(result)
+    else:
+        print(result)
+
+if __name__=='__main__':
+    # the API imports this module, fire is only needed on the command line
+    import fire
+    fire.Fire(main)
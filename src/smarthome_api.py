@@ -1,15 +1,42 @@
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+from fastapi import FastAPI,Request
 from fastapi.exceptions import HTTPException
+from fastapi.responses import PlainTextResponse,StreamingResponse
+import json
 import logging
 import os
-from smartstrip import ConfigurationError,UnknownDeviceError,SmartStrip
+import signal
+import asyncio
+import time
+import yaml
 from pathlib import Path
+from smartstrip import ConfigurationError,UnknownDeviceError
+from drivers import DeviceError
+from commands import CircuitOpenError
+from fleet import Fleet
+from scheduler import Scheduler
+from broadcast import Broadcaster,format_sse,poll
+from cluster import Cluster
+import metrics
 from pydantic import BaseModel
 from datetime import datetime
 
+metrics.startup.mark('imports')
+
 class PlugSet(BaseModel):
     state: int
 
+class ProfilerSet(BaseModel):
+    enabled: bool
+    interval: float | None = None
+
+class SimulateSet(BaseModel):
+    start: float | str | None = None
+    end: float | str | None = None
+    days: float | None = None
+    daily: bool = False
+    config: str | None = None
+
 # --- Configure logger
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -28,52 +55,413 @@ for env_var in required_env_vars:
         raise ConfigurationError(f"Environment Variables {env_var} is missing")
     logger.info(f"{env_var}={os.environ[env_var]}")
 
-api = FastAPI()
+if os.environ.get('SMARTHOME_PROFILER')=='1':
+    metrics.profiler.start()
+
+# KASA_OUTLET_CONFIG may list several config files separated by `:`
+fleet = Fleet.from_env(logger=logger)
+metrics.startup.mark('config')
+for instrumented_logger in [logger]+[strip.logger for strip in fleet.strips.values()]:
+    metrics.instrument_logger(instrumented_logger)
+
+scheduler = Scheduler(fleet,logger=logger)
+# numpy and pyarrow take a noticeable part of startup on a Pi, telemetry and /simulate load them on first use
+telemetry = None
+sampling = False
+recovery = None
+
+# plug state changes, scheduled transitions and device errors fan out to /events/stream subscribers
+broadcaster = Broadcaster(logger=logger)
+fleet.listen(broadcaster.publish)
+scheduler.listeners.append(broadcaster.publish)
+poll_interval = float(os.environ.get('SMARTHOME_POLL_INTERVAL',30))
+keepalive_interval = 15
+
+def load_telemetry():
+    """ the fleet's Telemetry, None while no device has a `telemetry` section """
+    global telemetry
+    if telemetry is None and any(strip.config.get('telemetry') is not None for strip in fleet.strips.values()):
+        from telemetry import Telemetry
+        telemetry = Telemetry(fleet,logger=logger)
+    return telemetry
+
+async def startup():
+    global recovery,sampling
+    # restore every device and rebase the queues to now before the scheduler takes over
+    recovery = await fleet.arecover(int(datetime.now().timestamp()))
+    metrics.startup.mark('first_reconcile')
+    logger.info(f"startup: {json.dumps(metrics.startup.report())}")
+    # devices with `scheduler: false` have no plugs in it
+    scheduler.start()
+    sampling = True
+    if load_telemetry() is not None:
+        telemetry.start()
+
+async def demoted():
+    global sampling
+    sampling = False
+    await scheduler.stop()
+    if telemetry is not None:
+        await telemetry.stop()
+
+async def set_action(device,plug,state):
+    return await fleet.get(device).aset_states({plug:state})
+
+async def handle_action(device=None,plug=None,state=None):
+    """ reconciles one plug, one device or, without a device, the whole fleet, and reschedules what was handled """
+    time_mark = int(datetime.now().timestamp())
+    if device is None:
+        results = await fleet.ahandle_all(time_mark)
+        for name,result in results.items():
+            if 'plugs' in result:
+                await scheduler.reschedule(name,*result['plugs'])
+        return results
+    strip = fleet.get(device)
+    if plug is None:
+        result = await strip.ahandle_all(time_mark)
+        await scheduler.reschedule(device,*result['plugs'])
+        return result
+    result = await strip.ahandle(plug,time_mark)
+    await scheduler.reschedule(device,plug)
+    return result
+
+actions = {'set':set_action,'handle':handle_action}
+
+# only the worker holding the leader lease drives the devices, the others (uvicorn --workers) read its snapshot
+cluster = Cluster.from_env(fleet,next(iter(fleet.strips.values())).store,actions=actions,logger=logger,on_elected=startup,on_demoted=demoted)
+fleet.listen(cluster.observe)
+cluster.listeners.append(broadcaster.publish)
 
-if 'KASA_OUTLET_CONFIG' in os.environ:
-    strip = SmartStrip(logger=logger,config_path=Path(os.environ['KASA_OUTLET_CONFIG']))
-else:
-    strip = SmartStrip(logger=logger)
+def follower():
+    return not cluster.leader
+
+async def run_action(action,device=None,plug=None,state=None):
+    """ runs an action here on the leader, or hands it to the leader.  a leader that is not done in time gives a pending token """
+    if not follower():
+        return await actions[action](device,plug,state)
+    result,token = await cluster.call(action,device=device,plug=plug,state=state)
+    return result if token is None else {'pending':token}
+
+# config file changes are applied without a restart, on SIGHUP and when a file's mtime changes
+reload_interval = float(os.environ.get('SMARTHOME_RELOAD_INTERVAL',5))
+
+async def reload_config():
+    """ applies config file changes, only the worker that drives the devices rebases queues and sets plugs """
+    drives = not follower()
+    try:
+        changes = await fleet.areload(int(datetime.now().timestamp()) if drives else None)
+    except (ConfigurationError,yaml.YAMLError,OSError) as err:
+        logger.error(f"config reload failed, keeping the running config: {err}")
+        return None
+    if drives:
+        for device,change in changes.items():
+            scheduler.forget(device,*change['plugs'])
+            if change['action'] != 'removed':
+                await scheduler.reschedule(device,*change['plugs'])
+        cluster.dirty.update(name for name in changes if name in fleet.strips)
+    if telemetry is not None:
+        await telemetry.reload(changes)
+    elif load_telemetry() is not None and sampling:
+        # the first device with a `telemetry` section
+        telemetry.start()
+    return changes
+
+def config_mtimes():
+    return {path:path.stat().st_mtime_ns if path.exists() else None for path in fleet.config_paths}
+
+async def watch_config(interval):
+    """ every worker watches the config files on its own """
+    mtimes = await asyncio.to_thread(config_mtimes)
+    while True:
+        await asyncio.sleep(interval)
+        current = await asyncio.to_thread(config_mtimes)
+        if current != mtimes:
+            mtimes = current
+            await reload_config()
+
+@asynccontextmanager
+async def lifespan(api):
+    broadcaster.attach()
+    tasks = []
+    # the leader runs startup() once it is elected, a single worker wins the lease here
+    await cluster.join()
+    cluster.start()
+    tasks.append(asyncio.create_task(poll(fleet,broadcaster,interval=poll_interval,drives=lambda: not follower())))
+    if reload_interval > 0:
+        tasks.append(asyncio.create_task(watch_config(reload_interval)))
+    # finished reloads drop out, reloads run one at a time under the fleet's reload lock
+    reloads = set()
+    def reload_on_signal():
+        task = asyncio.create_task(reload_config())
+        reloads.add(task)
+        task.add_done_callback(reloads.discard)
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP,reload_on_signal)
+    except (NotImplementedError,RuntimeError,ValueError):
+        # signals can only be handled on the main thread, as under uvicorn
+        pass
+    yield
+    for task in [*tasks,*reloads]:
+        task.cancel()
+    await cluster.stop()
+    await scheduler.stop()
+    if telemetry is not None:
+        await telemetry.stop()
+    fleet.close()
+
+api = FastAPI(lifespan=lifespan)
+
+def device_unavailable(err):
+    # an open circuit fails fast, tell the client when the device will be tried again
+    headers = {'Retry-After':str(int(err.retry_after)+1)} if isinstance(err,CircuitOpenError) and err.retry_after is not None else None
+    return HTTPException(status_code=503, detail=str(err), headers=headers)
 
 # healthcheck route
 # curl http://127.0.0.1:8000/healthcheck
 @api.get("/healthcheck")
 async def healthcheck():
-    global strip
-    return strip.status()
+    global fleet
+    if follower():
+        return cluster.states()
+    return await fleet.astatus()
+
+# server-sent events: a `snapshot` of every plug, then `state`, `transition` and `error` events as they happen
+# curl -N http://127.0.0.1:8000/events/stream
+# curl -N http://127.0.0.1:8000/events/stream?device=GardenOutletStrip
+@api.get("/events/stream")
+async def event_stream(request: Request, device: str | None = None):
+    global fleet
+    if device is not None and device not in fleet.strips:
+        raise HTTPException(status_code=404, detail=f"{device} not in config")
+    last_event_id = request.headers.get('last-event-id')
+    last_id = int(last_event_id) if last_event_id is not None and last_event_id.isdigit() else None
+    async def stream():
+        with broadcaster.subscribe(last_id=last_id) as queue:
+            devices = cluster.states() if follower() else await fleet.astatus()
+            if device is not None:
+                # None until the leader published the device or after a failed read, the stream still starts
+                devices = {device:devices.get(device)}
+            yield format_sse(None,{'type':'snapshot','at':time.time(),'devices':devices})
+            while True:
+                try:
+                    event_id,event = await asyncio.wait_for(queue.get(),timeout=keepalive_interval)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if device is None or event.get('device') == device:
+                    yield format_sse(event_id,event)
+    return StreamingResponse(stream(),media_type="text/event-stream",headers={'Cache-Control':'no-cache','X-Accel-Buffering':'no'})
+
+# outcome of a command that was still retrying when POST /plug returned {..., "pending": token}
+# curl http://127.0.0.1:8000/commands/GardenOutletStrip:1
+@api.get("/commands/{token:path}")
+async def get_command(token:str):
+    global fleet
+    try:
+        if token.startswith('outbox:'):
+            result = await cluster.lookup(token)
+        else:
+            result = await fleet.alookup_command(token)
+    except UnknownDeviceError as unk:
+        raise HTTPException(status_code=404, detail=str(unk))
+    if result is None:
+        raise HTTPException(status_code=404, detail=f"command {token} is unknown or expired")
+    return result
+
+# circuit breaker state and pending commands per device
+# curl http://127.0.0.1:8000/stats/commands
+@api.get("/stats/commands")
+async def command_stats():
+    global fleet
+    return fleet.command_stats()
+
+# leader lease and snapshot age when running several workers
+# curl http://127.0.0.1:8000/stats/cluster
+@api.get("/stats/cluster")
+async def cluster_stats():
+    return await asyncio.to_thread(cluster.stats)
+
+# duty cycle and power of a plug from the telemetry rollups, start and end are epoch seconds (default: the last 24h)
+# resolution is minute, hour or day, by default the finest that keeps the response small
+# curl "http://127.0.0.1:8000/telemetry/GardenOutletStrip/TowerGarden?resolution=day&start=1735689600"
+@api.get("/telemetry/{plug_name:path}")
+async def get_telemetry(plug_name:str, start: float | None = None, end: float | None = None, resolution: str | None = None):
+    global fleet
+    try:
+        strip,plug_name = fleet.resolve(plug_name)
+        if plug_name not in strip.config['plugs']:
+            raise UnknownDeviceError(f"{plug_name} not valid")
+    except UnknownDeviceError as unk:
+        raise HTTPException(status_code=404, detail=str(unk))
+    sampler = load_telemetry()
+    store = sampler.get(strip.config['name']) if sampler is not None else None
+    if store is None:
+        raise HTTPException(status_code=404, detail=f"{strip.config['name']} has no telemetry configured")
+    end = end if end is not None else time.time()
+    start = start if start is not None else end-86400
+    try:
+        result = await asyncio.to_thread(store.query,start,end,plug=plug_name,resolution=resolution)
+    except ValueError as err:
+        raise HTTPException(status_code=400, detail=str(err))
+    return {'device':strip.config['name'],'plug':plug_name,'start':start,'end':end,**result}
+
+# state cache counters
+# curl http://127.0.0.1:8000/stats/cache
+@api.get("/stats/cache")
+async def cache_stats():
+    global fleet
+    return fleet.cache_stats()
+
+# seconds from process start to imports, config loaded and first reconcile, with the recovery pass result
+# curl http://127.0.0.1:8000/stats/startup
+@api.get("/stats/startup")
+async def startup_stats():
+    return {**metrics.startup.report(),'recovery':recovery}
+
+# prometheus metrics
+# curl http://127.0.0.1:8000/metrics
+@api.get("/metrics",response_class=PlainTextResponse)
+async def get_metrics():
+    global fleet
+    def collect():
+        depth = {}
+        cache = {}
+        for name,strip in fleet.strips.items():
+            depth.update({(strip.get_key(plug),):count for plug,count in strip.get_queue_depth().items()})
+            for result,count in strip.cache_stats().items():
+                if result in ('hits','misses','coalesced'):
+                    cache[(name,result)] = count
+        metrics.queue_depth.replace(depth)
+        metrics.state_cache.replace(cache)
+        metrics.circuit_open.replace({(name,):int(stats['circuit']=='open') for name,stats in fleet.command_stats().items()})
+        metrics.scheduler_overdue.set(scheduler.overdue())
+    await asyncio.to_thread(collect)
+    return metrics.registry.render()
+
+# sampling profiler, collapsed stacks for flamegraph tools
+# curl -X POST --header "Content-Type: application/json" --data '{"enabled":true}' http://127.0.0.1:8000/debug/profiler
+# curl http://127.0.0.1:8000/debug/profiler/stacks
+@api.get("/debug/profiler")
+async def get_profiler():
+    return metrics.profiler.status()
+
+@api.post("/debug/profiler")
+async def set_profiler(profiler_set: ProfilerSet):
+    if profiler_set.enabled:
+        metrics.profiler.start(interval=profiler_set.interval)
+    else:
+        await asyncio.to_thread(metrics.profiler.stop)
+    return metrics.profiler.status()
+
+@api.get("/debug/profiler/stacks",response_class=PlainTextResponse)
+async def get_profiler_stacks():
+    return metrics.profiler.collapsed()
+
+# what-if run of the schedules: on-hours and cycles per plug per day and overlap between plugs, nothing is switched
+# `config` is the YAML of a config file to try, the running config is used without it
+# curl -X POST --header "Content-Type: application/json" --data '{"start":"2026-01-01","end":"2027-01-01"}' http://127.0.0.1:8000/simulate
+@api.post("/simulate")
+async def run_simulation(simulate_set: SimulateSet):
+    global fleet
+    def run():
+        import simulate
+        if simulate_set.config is not None:
+            devices = simulate.load_devices(Path('request.yml'),simulate_set.config.encode())
+        else:
+            devices = {name:(strip.config,strip.schedules) for name,strip in fleet.strips.items()}
+        start,end = simulate.time_range(devices,simulate_set.start,simulate_set.end,simulate_set.days)
+        return simulate.simulate(devices,start,end,daily=simulate_set.daily)
+    try:
+        return await asyncio.to_thread(run)
+    except (ConfigurationError,ValueError,yaml.YAMLError) as err:
+        raise HTTPException(status_code=400, detail=str(err))
+
+# upcoming scheduled transitions
+# curl http://127.0.0.1:8000/scheduler
+@api.get("/scheduler")
+async def get_schedule():
+    global scheduler
+    if follower():
+        # the leader's scheduler runs in another process, read its queue
+        await scheduler.load()
+    return scheduler.upcoming()
 
 # plug set route
 # curl --header "Content-Type: application/json" \
 #      --request POST \
 #      --data '{"state":1}' \
-#      http://127.0.0.1:8000/plug/TowerGarden
+#      http://127.0.0.1:8000/plug/GardenOutletStrip/TowerGarden
 @api.post("/plug/{plug_name:path}")
 async def set_plug(plug_name:str,plug_set: PlugSet):
-    global strip
+    global fleet
     result = None
     try:
+        strip,plug_name = fleet.resolve(plug_name)
+        if follower():
+            if plug_name not in strip.config['plugs']:
+                raise UnknownDeviceError(f"{plug_name} not in config")
+            result = await run_action('set',strip.config['name'],plug_name,plug_set.state)
+            return {plug_name:plug_set.state,**result} if 'pending' in result else result
         if plug_set.state==1:
-            result = strip.on(plug_name)
+            result = await strip.aon(plug_name)
         else:
-            result = strip.off(plug_name)
+            result = await strip.aoff(plug_name)
         return result
     except UnknownDeviceError as unk:
         raise HTTPException(status_code=404, detail=str(unk))
+    except DeviceError as err:
+        raise device_unavailable(err)
 
 @api.get("/plug/{plug_name:path}")
-# curl http://127.0.0.1:8000/plug/TowerGarden
+# curl http://127.0.0.1:8000/plug/GardenOutletStrip/TowerGarden
 async def get_plug(plug_name:str):
-    global strip
+    global fleet
+    try:
+        strip,plug_name = fleet.resolve(plug_name)
+        if follower():
+            states = cluster.states().get(strip.config['name'])
+            if states is None:
+                raise DeviceError(f"{strip.config['name']} state is not available")
+            if plug_name not in states:
+                raise UnknownDeviceError(f"{plug_name} not valid")
+            return {plug_name:states[plug_name]}
+        return {plug_name:await strip.aget_current_state(plug_name)}
+    except UnknownDeviceError as unk:
+        raise HTTPException(status_code=404, detail=str(unk))
+    except DeviceError as err:
+        raise device_unavailable(err)
+
+@api.patch("/plugs")
+# curl -X PATCH http://127.0.0.1:8000/plugs
+async def trigger_plugs():
+    global fleet
+    try:
+        return await run_action('handle')
+    except DeviceError as err:
+        raise device_unavailable(err)
+
+@api.patch("/plugs/{device}")
+# curl -X PATCH http://127.0.0.1:8000/plugs/GardenOutletStrip
+async def trigger_device_plugs(device:str):
+    global fleet
     try:
-        return {plug_name:strip.get_current_state(plug_name)}
+        fleet.get(device)
+        return await run_action('handle',device)
     except UnknownDeviceError as unk:
         raise HTTPException(status_code=404, detail=str(unk))
+    except DeviceError as err:
+        raise device_unavailable(err)
 
 @api.patch("/plug/{plug_name:path}")
-# curl -X PATCH http://127.0.0.1:8000/plug/TowerGarden
+# curl -X PATCH http://127.0.0.1:8000/plug/GardenOutletStrip/TowerGarden
 async def trigger_plug(plug_name:str):
-    global strip
+    global fleet
     try:
-        return strip.handle(plug_name,int(datetime.now().timestamp()))
+        strip,plug_name = fleet.resolve(plug_name)
+        if plug_name not in strip.config['plugs']:
+            raise UnknownDeviceError(f"{plug_name} not valid")
+        return await run_action('handle',strip.config['name'],plug_name)
     except UnknownDeviceError as unk:
         raise HTTPException(status_code=404, detail=str(unk))
+    except DeviceError as err:
+        raise device_unavailable(err)
@@ -0,0 +1,258 @@
+import asyncio
+import fire
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import yaml
+from datetime import datetime
+from pathlib import Path
+from fleet import Fleet
+from storage import EventStore
+
+# Benchmarks run against the simulated driver, no device is needed.
+#   python smarthome_bench.py --strips 4 --plugs 6 --latency 0.02 --output bench.json
+# Every benchmark is also available on its own, e.g. `python smarthome_bench.py queue --sizes [1000,100000]`
+
+def summarize(samples):
+    """ latency summary in milliseconds """
+    samples = sorted(samples)
+    def percentile(p):
+        return samples[min(len(samples)-1,int(p*len(samples)))]*1000
+    return {
+        'count':len(samples),
+        'mean_ms':statistics.fmean(samples)*1000,
+        'p50_ms':percentile(0.50),
+        'p95_ms':percentile(0.95),
+        'p99_ms':percentile(0.99),
+        'max_ms':samples[-1]*1000,
+    }
+
+def write_config(work_dir,strips,plugs,latency,loss,state_ttl=2):
+    """ writes a fleet config of `strips` simulated strips with `plugs` plugs each, half of them scheduled """
+    devices = []
+    for s in range(strips):
+        device_plugs = {}
+        for p in range(plugs):
+            plug = {'default':'off'}
+            if p % 2 == 0:
+                plug['schedule'] = {'type':'repeating','cycle_on':'00:00:01','cycle_off':'00:00:01'}
+            device_plugs[f"Plug{p}"] = plug
+        devices.append({'name':f"BenchStrip{s}",'host':f"sim-{s}",'plugs':device_plugs})
+    config = {
+        'max_concurrency':max(strips,1),
+        'log_level':'WARNING',
+        'log_path':str(work_dir/'log'),
+        'db_path':str(work_dir/'devices.db'),
+        'timezone':'UTC',
+        'type':'strip',
+        'driver':'simulated',
+        'state_ttl':state_ttl,
+        'simulator':{'latency':latency,'loss':loss,'children':plugs},
+        'devices':devices,
+    }
+    config_path = work_dir/f"bench-{strips}x{plugs}.yml"
+    with open(config_path,'w') as config_file:
+        yaml.safe_dump(config,config_file)
+    return config_path
+
+def get_logger():
+    logger = logging.getLogger('smarthome_bench')
+    logger.setLevel(logging.WARNING)
+    return logger
+
+async def bench_handle(fleet,iterations):
+    strip = next(iter(fleet.strips.values()))
+    plug = next(iter(strip.config['plugs']))
+    now = int(datetime.now().timestamp())
+    samples = []
+    for i in range(iterations):
+        started = time.perf_counter()
+        await strip.ahandle(plug,now+i)
+        samples.append(time.perf_counter()-started)
+    return {'plug':strip.get_key(plug),**summarize(samples)}
+
+async def bench_reconcile(fleet,rounds):
+    now = int(datetime.now().timestamp())
+    samples = []
+    errors = 0
+    plug_count = sum(len(strip.config['plugs']) for strip in fleet.strips.values())
+    for i in range(rounds):
+        started = time.perf_counter()
+        results = await fleet.ahandle_all(now+i)
+        samples.append(time.perf_counter()-started)
+        for result in results.values():
+            # a failed read fails the whole device, a failed write only its plugs
+            errors += plug_count//len(fleet.strips) if 'error' in result else sum(1 for plug in result['plugs'].values() if plug.get('error'))
+    total = sum(samples)
+    return {
+        'strips':len(fleet.strips),
+        'plugs':plug_count,
+        'rounds':rounds,
+        'plug_errors':errors,
+        'plugs_per_second':plug_count*rounds/total if total > 0 else None,
+        'round':summarize(samples),
+    }
+
+async def asgi_get(app,path):
+    """ calls an ASGI app directly, returns (status, body) """
+    scope = {
+        'type':'http','asgi':{'version':'3.0'},'http_version':'1.1','method':'GET','scheme':'http',
+        'path':path,'raw_path':path.encode(),'query_string':b'','root_path':'',
+        'headers':[(b'host',b'bench')],'client':('127.0.0.1',0),'server':('bench',80),
+    }
+    response = {'status':None,'body':b''}
+    async def receive():
+        return {'type':'http.request','body':b'','more_body':False}
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+        elif message['type'] == 'http.response.body':
+            response['body'] += message.get('body',b'')
+    await app(scope,receive,send)
+    return response['status'],response['body']
+
+async def bench_healthcheck(api_module,requests,concurrency):
+    """ runs the API's lifespan, so the process holds the leader lease and answers from the devices, then times /healthcheck """
+    app = api_module.api
+    devices = set(api_module.fleet.strips)
+    semaphore = asyncio.Semaphore(concurrency)
+    samples = []
+    failures = 0
+    # answers without the states of every device: an unreachable one, or an API that is not driving the devices
+    missing = 0
+    async def request():
+        nonlocal failures,missing
+        async with semaphore:
+            started = time.perf_counter()
+            status,body = await asgi_get(app,'/healthcheck')
+            samples.append(time.perf_counter()-started)
+            if status != 200:
+                failures += 1
+                return
+            states = json.loads(body)
+            if set(states) != devices or not all(isinstance(plugs,dict) and 'error' not in plugs for plugs in states.values()):
+                missing += 1
+    async with app.router.lifespan_context(app):
+        # the startup recovery runs once the lease is won, timing starts after it
+        while api_module.recovery is None:
+            await asyncio.sleep(0.01)
+        started = time.perf_counter()
+        await asyncio.gather(*[request() for _ in range(requests)])
+        elapsed = time.perf_counter()-started
+    if missing == requests:
+        raise RuntimeError("/healthcheck returned no device states")
+    return {'requests':requests,'concurrency':concurrency,'failures':failures,'missing_states':missing,'requests_per_second':requests/elapsed,'latency':summarize(samples)}
+
+def bench_queue_size(work_dir,size,operations):
+    """ times the queue operations of one key while `size` other rows sit in events and event_history """
+    store = EventStore.get(work_dir/f"queue-{size}.db")
+    now = time.time()
+    batch = 10000
+    with store.transaction() as cur:
+        for offset in range(0,size,batch):
+            rows = [(f"Bench/Strip{i%50}/Plug{i%8}",i%2,json.dumps({'set':i%2}),now+i) for i in range(offset,min(offset+batch,size))]
+            cur.executemany("INSERT INTO events (device_key,current_state,event,event_at) VALUES(?,?,?,?)",rows)
+            cur.executemany("INSERT INTO event_history (device_key,state,event,event_at) VALUES(?,?,?,?)",[(k,s,e,at-size) for k,s,e,at in rows])
+    key = "Bench/Target/Plug"
+    timings = {'put':[],'expected_state':[],'pop':[],'next_events':[],'history_page':[]}
+    for i in range(operations):
+        started = time.perf_counter()
+        with store.transaction() as cur:
+            store.put(key,i%2,{'set':1-i%2},now+i,cur)
+        timings['put'].append(time.perf_counter()-started)
+        started = time.perf_counter()
+        with store.transaction() as cur:
+            store.get_expected_state(key,cur)
+        timings['expected_state'].append(time.perf_counter()-started)
+        started = time.perf_counter()
+        with store.transaction() as cur:
+            store.pop(key,now+i,cur)
+        timings['pop'].append(time.perf_counter()-started)
+        started = time.perf_counter()
+        store.get_next_events("Bench/Strip1/")
+        timings['next_events'].append(time.perf_counter()-started)
+        started = time.perf_counter()
+        store.query_history(["Bench/Strip1/Plug1"],limit=100)
+        timings['history_page'].append(time.perf_counter()-started)
+    return {'rows':size,**{name:summarize(samples) for name,samples in timings.items()}}
+
+class Bench():
+    """ SmartStrip and API benchmarks against simulated strips, results are JSON """
+
+    def __init__(self,strips=4,plugs=6,latency=0.02,loss=0.0,output=None):
+        self.strips = strips
+        self.plugs = plugs
+        self.latency = latency
+        self.loss = loss
+        self.output = output
+
+    def meta(self,benchmarks):
+        return {
+            'started_at':datetime.now().isoformat(),
+            'python':sys.version.split()[0],
+            'platform':platform.platform(),
+            'benchmarks':benchmarks,
+            'params':{'strips':self.strips,'plugs':self.plugs,'latency':self.latency,'loss':self.loss},
+        }
+
+    def emit(self,results):
+        report = json.dumps(results,indent=2)
+        if self.output is not None:
+            Path(self.output).write_text(report+'\n')
+        return report
+
+    def handle(self,iterations=200):
+        with tempfile.TemporaryDirectory() as work_dir:
+            fleet = Fleet([write_config(Path(work_dir),1,self.plugs,self.latency,self.loss)],logger=get_logger())
+            try:
+                return asyncio.run(bench_handle(fleet,iterations))
+            finally:
+                fleet.close()
+
+    def reconcile(self,rounds=20):
+        with tempfile.TemporaryDirectory() as work_dir:
+            fleet = Fleet([write_config(Path(work_dir),self.strips,self.plugs,self.latency,self.loss)],logger=get_logger())
+            try:
+                return asyncio.run(bench_reconcile(fleet,rounds))
+            finally:
+                fleet.close()
+
+    def healthcheck(self,requests=500,concurrency=32,state_ttl=2):
+        with tempfile.TemporaryDirectory() as work_dir:
+            os.environ['KASA_OUTLET_CONFIG'] = str(write_config(Path(work_dir),self.strips,self.plugs,self.latency,self.loss,state_ttl=state_ttl))
+            # the API builds its fleet at import, the lifespan (startup recovery, scheduler) runs for the benchmark and closes it
+            import smarthome_api
+            smarthome_api.logger.setLevel(logging.WARNING)
+            return asyncio.run(bench_healthcheck(smarthome_api,requests,concurrency))
+
+    def queue(self,sizes=(1000,10000,100000),operations=200):
+        with tempfile.TemporaryDirectory() as work_dir:
+            return [bench_queue_size(Path(work_dir),int(size),operations) for size in sizes]
+
+    def all(self):
+        results = {'meta':self.meta(['handle','reconcile','healthcheck','queue'])}
+        results['handle'] = self.handle()
+        results['reconcile'] = self.reconcile()
+        results['healthcheck'] = self.healthcheck()
+        results['queue'] = self.queue()
+        return self.emit(results)
+
+    def run(self,benchmark,**kwargs):
+        results = {'meta':self.meta([benchmark]),benchmark:getattr(self,benchmark)(**kwargs)}
+        return self.emit(results)
+
+def main(benchmark='all',strips=4,plugs=6,latency=0.02,loss=0.0,output=None,**kwargs):
+    bench = Bench(strips=strips,plugs=plugs,latency=latency,loss=loss,output=output)
+    if benchmark == 'all':
+        return bench.all()
+    if benchmark not in ('handle','reconcile','healthcheck','queue'):
+        raise ValueError(f"unknown benchmark {benchmark}")
+    return bench.run(benchmark,**kwargs)
+
+if __name__=='__main__':
+    fire.Fire(main)
@@ -1,10 +1,12 @@
 import streamlit as st
 from streamlit.logger import get_logger
 from smartstrip import ConfigurationError,UnknownDeviceError,SmartStrip
+from fleet import Fleet
+from broadcast import StreamClient
+from schedule import get_timezone
 import os
 import pandas as pd
-from pathlib import Path
-from datetime import datetime
+from datetime import datetime,timedelta
 
 logger = get_logger(__name__)
 class ConfigurationError(Exception):
@@ -19,18 +21,106 @@ for env_var in required_env_vars:
         raise ConfigurationError(f"Environment Variables {env_var} is missing")
     logger.info(f"{env_var}={os.environ[env_var]}")
 
-if 'KASA_OUTLET_CONFIG' in os.environ:
-    strip = SmartStrip(logger=logger,config_path=Path(os.environ['KASA_OUTLET_CONFIG']))
-else:
-    strip = SmartStrip(logger=logger)
+@st.cache_resource
+def get_fleet():
+    return Fleet.from_env(logger=logger)
+
+# live state comes from the API's event stream, the queries below are re-run when it reports a change
+@st.cache_resource
+def get_stream():
+    api_url = os.environ.get('SMARTHOME_API_URL','http://127.0.0.1:8000')
+    return StreamClient(f"{api_url}/events/stream",logger=logger).start()
+
+@st.cache_data(ttl=300)
+def load_pending(device):
+    events = get_fleet().get(device).get_pending_events()
+    return pd.DataFrame(events,columns=["device_key","current_state","event","event_at"])
+
+@st.cache_data(ttl=300)
+def load_history(device,plug,start,end,after,limit):
+    page = get_fleet().get(device).query_events(plug=plug,start=start,end=end,after=after,limit=limit)
+    return pd.DataFrame(page['events'],columns=["id","device_key","state","event","event_at","applied_at"]),page['next']
+
+@st.cache_data(ttl=300)
+def load_on_time(device,plug,start,end):
+    on_time = get_fleet().get(device).get_on_time(start,end,plug=plug)
+    rows = [(p,bucket,seconds) for p,buckets in on_time.items() for bucket,seconds in buckets]
+    return pd.DataFrame(rows,columns=["plug","hour","on_seconds"])
+
+def to_local(df,column,timezone):
+    return pd.to_datetime(df[column],unit='s',utc=True).dt.tz_convert(timezone)
+
+fleet = get_fleet()
+stream = get_stream()
 
 # Set page title
 st.title('CAMPSmith Smart Home')
 
 with st.expander("config"):
-    st.write(strip.config)
+    for strip in fleet.strips.values():
+        st.write(strip.config)
 
-df = strip.get_events_df()
-df['event_at'] = df['event_at'].astype('str')
-df['event time'] = df['event_at'].apply(lambda t: datetime.fromtimestamp(int(float(t))).isoformat())
+device = st.selectbox("device",list(fleet.strips))
+strip = fleet.get(device)
+timezone = strip.config['timezone']
+plug = st.selectbox("plug",["All"]+list(strip.config['plugs']))
+plug = None if plug=="All" else plug
+# dates are the device's local days, as the tables below show them, not the days of the host running the console
+device_timezone = get_timezone(timezone)
+today = datetime.now(device_timezone).date()
+dates = st.date_input("dates",(today-timedelta(days=7),today))
+start_date,end_date = dates if len(dates)==2 else (dates[0],dates[0])
+start = datetime.combine(start_date,datetime.min.time(),tzinfo=device_timezone).timestamp()
+end = datetime.combine(end_date+timedelta(days=1),datetime.min.time(),tzinfo=device_timezone).timestamp()
+
+@st.fragment(run_every=2)
+def live(device):
+    states,events,changes = stream.snapshot()
+    if not stream.connected:
+        st.caption("event stream is not connected, history refreshes every 5 minutes")
+    st.dataframe(pd.DataFrame([(plug,state) for plug,state in states.get(device,{}).items()],columns=["plug","state"]),hide_index=True)
+    recent = pd.DataFrame([e for e in events if e.get('device')==device][-20:],columns=["at","type","plug","state","error"])
+    recent['time'] = to_local(recent,'at',timezone)
+    st.dataframe(recent.iloc[::-1],hide_index=True)
+    if st.session_state.get('stream_changes') != changes:
+        first = 'stream_changes' not in st.session_state
+        st.session_state['stream_changes'] = changes
+        if not first:
+            load_pending.clear()
+            load_history.clear()
+            load_on_time.clear()
+            st.rerun()
+
+st.subheader("live")
+live(device)
+
+st.subheader("pending")
+df = load_pending(device).copy()
+df['event time'] = to_local(df,'event_at',timezone)
 st.dataframe(df[["device_key","current_state","event","event_at","event time"]],hide_index=True)
+
+st.subheader("on time per hour")
+on_time = load_on_time(device,plug,start,end)
+if len(on_time)>0:
+    on_time['hour'] = to_local(on_time,'hour',timezone)
+    on_time['on_minutes'] = on_time['on_seconds']/60
+    st.bar_chart(on_time,x="hour",y="on_minutes",color="plug")
+
+st.subheader("history")
+# keyset pagination, the cursors of the pages visited so far are kept to go back
+query = (device,plug,start,end)
+if st.session_state.get('history_query') != query:
+    st.session_state['history_query'] = query
+    st.session_state['history_cursors'] = [None]
+cursors = st.session_state['history_cursors']
+page_size = st.selectbox("page size",[50,100,500])
+df,next_cursor = load_history(device,plug,start,end,cursors[-1],page_size)
+df['event time'] = to_local(df,'event_at',timezone)
+st.dataframe(df[["device_key","state","event","event_at","event time"]],hide_index=True)
+previous_column,next_column = st.columns(2)
+if previous_column.button("newer",disabled=len(cursors)<2):
+    cursors.pop()
+    st.rerun()
+if next_column.button("older",disabled=next_cursor is None):
+    cursors.append(next_cursor)
+    st.rerun()
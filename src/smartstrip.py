@@ -1,14 +1,18 @@
 # import fire
+import asyncio
 import logging
-import subprocess
+import logging.handlers
 import json
 import os
 import yaml
 import time
 from pathlib import Path
-import sqlite3
-import pandas as pd
-from pathlib import Path
+import threading
+from drivers import DeviceError,PlugNotFoundError,create_driver,drivers
+from commands import CircuitOpenError,CommandQueue
+from schedule import DailySchedule,ScheduleError,compile_schedule,parse_duration
+from storage import EventStore
+import metrics
 
 class ConfigurationError(Exception):
     pass
@@ -20,37 +24,38 @@ class SmartStrip():
     config = None
     config_path = Path('/etc/campsmith/home/campsmith-devices.yml')
     logger = None
-    sqliteConnection = None
-    ddl=[
-        """
-        CREATE TABLE IF NOT EXISTS events (
-            id INTEGER PRIMARY KEY,
-            device_key VARCHAR(255) UNIQUE NOT NULL,
-            current_state INTEGER NOT NULL,
-            event_at REAL NOT NULL,
-            event VARCHAR(255) NOT NULL,
-            created_at REAL DEFAULT (strftime('%s', 'now')),
-            created_by INTEGER DEFAULT 1,
-            updated_at REAL DEFAULT (strftime('%s', 'now')),
-            updated_by INTEGER DEFAULT 1
-        );
-        """,
-        "CREATE UNIQUE INDEX IF NOT EXISTS idx_events_device_key ON events(device_key);"
-    ]
-
-    def __init__(self,config_path=None,logger=None):
+    driver = None
+    schedules = None
+    store = None
+    # a change to any of these replaces the device connection, the strip is rebuilt on reload
+    connection_keys = ('host','alias','mac','driver','simulator','username','password','device_timeout','db_path','type')
+
+    def __init__(self,config_path=None,logger=None,config=None,schedules=None):
         if logger is not None:
             self.logger = logger
 
         if config_path is not None:
             self.config_path = config_path
-        self.load_config()
+        self.queue_lock = threading.Lock()
+        self.state = None
+        self.state_at = 0
+        self.state_version = 0
+        self.state_inflight = None
+        self.state_lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_coalesced = 0
+        # last state seen of every plug, to tell listeners what changed
+        self.known = {}
+        self.listeners = []
+        self.load_config(config,schedules=schedules)
         self.init_db()
+        self.driver = create_driver(self.config,logger=self.logger)
+        # writes go through a per-device queue, reads share its circuit breaker
+        self.commands = CommandQueue(self.config['name'],self.driver,config=self.config,logger=self.logger,on_applied=self.applied,on_failed=self.failed,on_rejected=self.rejected)
 
     def get_conn(self):
-        if self.sqliteConnection is None:
-            self.sqliteConnection = sqlite3.connect(self.config["db_path"])
-        return self.sqliteConnection
+        return self.store.get_conn()
     
     def validate_config(self):
         """ Sample Config:
@@ -59,6 +64,9 @@ class SmartStrip():
         log_path: /var/log/smarthome
         db_path: /var/data/devices.db
         host: 192.168.0.156
+        mac: '5C:A6:E6:00:00:01'
+        driver: kasa
+        state_ttl: 2
         timezone: "America/Los_Angeles"
         type: strip
         plugs: 
@@ -78,8 +86,8 @@ class SmartStrip():
         """
         if 'name' not in self.config:
             raise ConfigurationError(f"config {self.config_path} is missing `name`")
-        if 'host' not in self.config:
-            raise ConfigurationError(f"config {self.config_path} is missing `host`")
+        if 'host' not in self.config and 'alias' not in self.config and 'mac' not in self.config:
+            raise ConfigurationError(f"config {self.config_path} is missing `host`, or an `alias` or `mac` to discover it by")
         if 'log_path' not in self.config:
             raise ConfigurationError(f"config {self.config_path} is missing `log_path`")
         if 'db_path' not in self.config:
@@ -93,6 +101,20 @@ class SmartStrip():
         
         if self.config['type'] not in ['strip']:
             raise ConfigurationError(f"{self.config['name']} type {self.config['type']} is not supported")
+        if self.config.get('driver','kasa') not in drivers:
+            raise ConfigurationError(f"{self.config['name']} driver {self.config['driver']} is not supported")
+        if not isinstance(self.config.get('state_ttl',0),(int,float)) or self.config.get('state_ttl',0) < 0:
+            raise ConfigurationError(f"{self.config['name']} state_ttl must be a number of seconds >= 0")
+        if not isinstance(self.config.get('scheduler',True),bool):
+            raise ConfigurationError(f"{self.config['name']} scheduler must be true or false")
+        if 'telemetry' in self.config:
+            telemetry = self.config['telemetry'] if self.config['telemetry'] is not None else {}
+            if not isinstance(telemetry,dict):
+                raise ConfigurationError(f"{self.config['name']} telemetry must be a mapping")
+            for key in ['interval','flush_interval','raw_days']:
+                if key in telemetry and (not isinstance(telemetry[key],(int,float)) or telemetry[key] <= 0):
+                    raise ConfigurationError(f"{self.config['name']} telemetry {key} must be a number > 0")
+            self.config['telemetry'] = telemetry
 
         device_name=[self.config['name']]
         for plug_name,plug_config in self.config['plugs'].items():
@@ -120,41 +142,56 @@ class SmartStrip():
                         raise ConfigurationError(f"schedule configuration for {device_name}/{plug_name} is not valid.  Repeating schedule definition is missing `cycle_off`. plug_config: {json.dumps(plug_config)}")
         return True
 
-    def init_db(self):
-        db_path = Path(self.config['db_path'])
-        if not db_path.exists():
-            if self.logger is not None:
-                self.logger.info(f"initializing devices db at {db_path}")
-            db_path.parent.mkdir(parents=True,exist_ok=True)
-        with self.get_conn() as conn:
-            tables_query="SELECT name FROM sqlite_master WHERE type='table' ORDER BY name"
-            cursor = conn.cursor()
-            res = cursor.execute(tables_query)
-            tables = res.fetchall()
-        if tables is None or len(tables)<1:
-            self.create_db()
-
-    def create_db(self):
-        if self.logger is not None:
-            self.logger.info(f"{self.config['db_path']} is not initialized.  initializing schema ...")
-        with self.get_conn() as conn:
-            for stmt in self.ddl:
-                cur = conn.cursor()
-                cur.execute(stmt)
-                conn.commit()
+    @classmethod
+    def check_config(cls,config,config_path=None,logger=None,validate=True):
+        """ validates a device config and returns its compiled schedules, without opening the database or the device.
+        a config that was validated before, as one from the config cache, only has its schedules compiled with validate=False
+        """
+        strip = cls.__new__(cls)
+        strip.config = config
+        strip.config_path = config_path if config_path is not None else cls.config_path
+        strip.logger = logger
+        if validate:
+            strip.validate_config()
+        return strip.compile_schedules()
 
+    def compile_schedules(self):
+        """ returns {plug: schedule} for every plug with a schedule, compiled once per config load """
+        schedules = {}
+        for plug_name,plug_config in self.config['plugs'].items():
+            if 'schedule' not in plug_config:
+                continue
+            try:
+                schedules[plug_name] = compile_schedule(plug_config['schedule'],self.config['timezone'],logger=self.logger)
+            except ScheduleError as err:
+                raise ConfigurationError(f"schedule configuration for {self.config['name']}/{plug_name} is not valid.  {err}") from err
+            if isinstance(schedules[plug_name],DailySchedule) and plug_config['default']=='on' and self.logger is not None:
+                self.logger.warning(f"{self.config['name']}/{plug_name} default 'on' is ignored, a daily schedule keeps the plug off outside of its windows")
+        return schedules
+
+    def init_db(self):
+        self.store = EventStore.get(self.config['db_path'],logger=self.logger)
 
-    def load_config(self):
-        if not self.config_path.exists():
-            raise ConfigurationError(f"Configuration Missing. config_path={self.config_path.resolve()} ")
+    def load_config(self,config=None,schedules=None):
+        # a fleet passes the device config it already read from config_path,
+        # with the compiled schedules when the config comes validated from its cache
+        if config is None:
+            if not self.config_path.exists():
+                raise ConfigurationError(f"Configuration Missing. config_path={self.config_path.resolve()} ")
 
-        with open(self.config_path, 'r') as config_file:
-            config = yaml.safe_load(config_file)
+            with open(self.config_path, 'r') as config_file:
+                config = yaml.safe_load(config_file)
         if config is None:
             raise ConfigurationError(f"Invalid configuration, config is None")
         self.config = config
-        self.validate_config()
+        if schedules is None:
+            self.validate_config()
+            schedules = self.compile_schedules()
+        self.schedules = schedules
+        self.configure_logger()
 
+    def configure_logger(self):
+        config = self.config
         if self.logger is not None:
             log_level = logging.INFO
             if  'log_level' in config:
@@ -168,71 +205,270 @@ class SmartStrip():
 
             if  'log_path' in config:
                 Path(config['log_path']).mkdir(parents=True, exist_ok=True)
-                log_file = f"{config['log_path']}/{config['name']}.log"
+                log_file = os.path.abspath(f"{config['log_path']}/{config['name']}.log")
+                # loggers are per device name and outlive a reload or a rebuilt strip, keep one file handler on them
+                for handler in list(self.logger.handlers):
+                    if isinstance(handler,logging.handlers.RotatingFileHandler) and os.path.basename(handler.baseFilename) == f"{config['name']}.log":
+                        if handler.baseFilename == log_file:
+                            return
+                        self.logger.removeHandler(handler)
+                        handler.close()
                 file_handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=(1048576*5), backupCount=7)
                 logFormatter = logging.Formatter("%(asctime)s [%(levelname)-5.5s]: %(message)s")
                 file_handler.setFormatter(logFormatter)
                 self.logger.addHandler(file_handler)
 
-    def status(self):
+    @metrics.timed('status')
+    async def read_status(self):
         if self.logger is not None:
             self.logger.debug("cmd = status")
-        result = subprocess.run(["kasa", "--json", "--host",self.config['host'], "state"], capture_output=True, text=True)
-        if result is None:
-            return None
-        if result.stdout is None:
-            return None
-        strip = json.loads(result.stdout)
-        if 'system' not in strip:
-            return None
-        if 'get_sysinfo' not in strip['system']:
-            return None
-        if 'children' not in strip['system']['get_sysinfo']:
-            return None
-        result = {}
-        for plug in strip['system']['get_sysinfo']['children']:
-            if 'alias' in plug and 'state' in plug:
-                result[plug['alias']]=plug['state']
+        version = self.state_version
+        result = None
+        probe = False
+        try:
+            probe = self.commands.check('status')
+            sysinfo = await self.driver.sysinfo()
+            self.commands.breaker.success()
+            if sysinfo is not None and 'children' in sysinfo:
+                result = {}
+                for plug in sysinfo['children']:
+                    if 'alias' in plug and 'state' in plug:
+                        result[plug['alias']]=plug['state']
+        except CircuitOpenError as err:
+            if self.logger is not None:
+                self.logger.debug(str(err))
+        except DeviceError as err:
+            self.commands.breaker.failure()
+            metrics.device_errors.inc(device=self.config['name'],operation='status')
+            if self.logger is not None:
+                self.logger.error(f"Unable to read {self.config['name']} state: {err}")
+            self.notify('error',operation='status',error=str(err))
+        except BaseException:
+            # cancelled or not a device error, a half-open probe must not hold the circuit open
+            if probe:
+                self.commands.breaker.release()
+            raise
+        finally:
+            with self.state_lock:
+                self.state_inflight = None
+                # a write that landed while the read was in flight makes the result stale
+                if result is not None and version == self.state_version:
+                    self.state = result
+                    self.state_at = time.monotonic()
+        if result is not None:
+            self.observe(result,'read')
         return result
 
-    def on(self,plug):
-        if plug not in self.config['plugs']:
-            raise UnknownDeviceError(f"{plug} not in config")
+    async def astatus(self,max_age=None):
+        """ returns {plug: state} for every plug on the strip.
+        readers share a cached snapshot for `state_ttl` seconds and concurrent cache misses share one device read.
+        """
+        ttl = self.config.get('state_ttl',2) if max_age is None else max_age
+        with self.state_lock:
+            if self.state is not None and time.monotonic()-self.state_at <= ttl:
+                self.cache_hits += 1
+                return dict(self.state)
+            if self.state_inflight is None:
+                self.cache_misses += 1
+                self.state_inflight = asyncio.run_coroutine_threadsafe(self.read_status(),self.driver.get_loop())
+            else:
+                self.cache_coalesced += 1
+            inflight = self.state_inflight
+        # one reader giving up must not cancel the read the others are waiting on
+        result = await asyncio.shield(asyncio.wrap_future(inflight))
+        return dict(result) if result is not None else None
+
+    def status(self,max_age=None):
+        return self.driver.call(self.astatus(max_age=max_age))
+
+    async def aread_emeter(self):
+        """ returns {plug: watts} for the plugs with an energy meter, {} when the strip has none or can not be read """
+        async def read():
+            probe = False
+            try:
+                probe = self.commands.check('emeter')
+                power = await self.driver.emeter()
+                self.commands.breaker.success()
+            except CircuitOpenError:
+                return {}
+            except DeviceError as err:
+                self.commands.breaker.failure()
+                metrics.device_errors.inc(device=self.config['name'],operation='emeter')
+                if self.logger is not None:
+                    self.logger.error(f"Unable to read {self.config['name']} energy meter: {err}")
+                return {}
+            except BaseException:
+                if probe:
+                    self.commands.breaker.release()
+                raise
+            return {plug:watts for plug,watts in power.items() if plug in self.config['plugs'] and watts is not None}
+        return await self.driver.acall(read())
+
+    def update_state(self,plug,state):
+        with self.state_lock:
+            self.state_version += 1
+            if state is None:
+                self.state = None
+            elif self.state is not None:
+                self.state[plug] = state
+
+    def notify(self,kind,**data):
+        """ passes {'type': kind, 'device': ..., 'at': ..., **data} to every listener, from whichever thread the change happened on """
+        event = {'type':kind,'device':self.config['name'],'at':time.time(),**data}
+        for listener in list(self.listeners):
+            try:
+                listener(event)
+            except Exception as err:
+                if self.logger is not None:
+                    self.logger.error(f"event listener failed: {err}")
+
+    def observe(self,states,source):
+        """ notifies listeners of the plugs in {plug: state} whose state differs from the last one seen """
+        with self.state_lock:
+            changed = {plug:state for plug,state in states.items() if self.known.get(plug) != state}
+            self.known.update(changed)
+        if len(self.listeners)>0:
+            for plug,state in changed.items():
+                self.notify('state',plug=plug,state=state,source=source)
+
+    def cache_stats(self):
+        with self.state_lock:
+            return {
+                'ttl': self.config.get('state_ttl',2),
+                'hits': self.cache_hits,
+                'misses': self.cache_misses,
+                'coalesced': self.cache_coalesced,
+                'age': time.monotonic()-self.state_at if self.state is not None else None,
+            }
+
+    def applied(self,states):
+        """ called by the command queue once {plug: state} is set on the device """
+        for plug,state in states.items():
+            self.update_state(plug,state)
+        self.observe(states,'write')
+
+    def rejected(self,operation):
+        """ called by the command queue for every request its open circuit turned away """
+        metrics.circuit_rejections.inc(device=self.config['name'],operation=operation)
+
+    def failed(self,states,err):
+        """ called by the command queue for every failed attempt """
+        metrics.device_errors.inc(device=self.config['name'],operation='set_states')
+        self.update_state(None,None)
         if self.logger is not None:
-            self.logger.debug("cmd = on")
-        result = subprocess.run(["kasa", "--json", "--host",self.config['host'], "on","--child",plug], capture_output=True, text=True)
-        if result is None:
-            if self.logger is not None:
-                self.logger.error(f"Unable to set{plug} state.")
-            return None
-        if result.returncode!= 0:
-            if self.logger is not None:
-                self.logger.error(f"Error setting {plug} state: [rc={result.returncode}]{result.stderr}")
-        return {plug: 1}
+            self.logger.error(f"Error setting {','.join(states)} state: {err}")
+        self.notify('error',operation='set_states',plugs=list(states),error=str(err))
 
-    def off(self,plug):
+    async def aset_state(self,plug,state):
+        """ returns {plug: state} once the device confirmed it, or {plug: state, 'pending': token} while the command is still retrying.
+        raises DeviceError when the command failed and CircuitOpenError while the device is failing
+        """
         if plug not in self.config['plugs']:
             raise UnknownDeviceError(f"{plug} not in config")
+        operation = 'on' if state==1 else 'off'
         if self.logger is not None:
-            self.logger.debug("cmd = off")
-        result = subprocess.run(["kasa", "--json", "--host",self.config['host'], "off","--child",plug], capture_output=True, text=True)
-        if result is None:
-            if self.logger is not None:
-                self.logger.error(f"Unable to set{plug} state.")
-            return None
-        if result.returncode!= 0:
-            if self.logger is not None:
-                self.logger.error(f"Error setting {plug} state: [rc={result.returncode}]{result.stderr}")
-        return {plug: 0}
+            self.logger.debug(f"cmd = {operation}")
+        started = time.perf_counter()
+        try:
+            return await self.driver.acall(self.commands.request({plug:state}))
+        finally:
+            metrics.operation_seconds.observe(time.perf_counter()-started,device=self.config['name'],operation=operation)
+
+    def diff_plugs(self,config,schedules):
+        """ plugs added, removed or with a different default or compiled schedule in a new config of this device.
+        turning `scheduler` on or off changes every scheduled plug
+        """
+        changed = []
+        toggled = self.config.get('scheduler',True) != config.get('scheduler',True)
+        for plug in {**self.config['plugs'],**config['plugs']}:
+            old = self.config['plugs'].get(plug)
+            new = config['plugs'].get(plug)
+            if old is None or new is None or old.get('default') != new.get('default') or self.schedules.get(plug) != schedules.get(plug):
+                changed.append(plug)
+            elif toggled and 'schedule' in new:
+                changed.append(plug)
+        return changed
+
+    def reload(self,config,schedules,time_mark=None):
+        """ swaps in a new validated config of this device, the connection settings must be unchanged.
+        the plugs whose schedule changed are rebased to time_mark, returns {plug: (intended_state, False)} of them.
+        without a time_mark the queues are left alone, as on a worker that does not drive the devices
+        """
+        changed = self.diff_plugs(config,schedules)
+        removed = [plug for plug in self.config['plugs'] if plug not in config['plugs']]
+        queue = {}
+        # queue readers hold queue_lock, they see either the old config and schedules or the new ones
+        with self.queue_lock:
+            self.config = config
+            self.schedules = schedules
+            if time_mark is not None and len(changed)>0:
+                with self.store.transaction() as cur:
+                    for plug_name in removed:
+                        self.store.clear(self.get_key(plug_name),cur)
+                    for plug_name in changed:
+                        if plug_name not in removed:
+                            queue[plug_name] = (self.rebase_plug(cur,plug_name,time_mark),False)
+        self.configure_logger()
+        self.commands.configure(config)
+        with self.state_lock:
+            for plug_name in removed:
+                self.known.pop(plug_name,None)
+        if self.logger is not None:
+            self.logger.info(f"config reloaded, changed plugs: {','.join(changed) if len(changed)>0 else 'none'}")
+        return queue
+
+    async def areload(self,config,schedules,time_mark):
+        """ reload() and bring the changed plugs to their intended state, same result shape as ahandle_all """
+        started = time.perf_counter()
+        queue = await asyncio.to_thread(self.reload,config,schedules,time_mark)
+        if len(queue)<1:
+            return {'plugs':{}}
+        return await self.aapply(queue,started)
+
+    @metrics.timed('set_states')
+    async def aset_states(self,states,return_exceptions=False):
+        """ sets several plugs with one batched device request and waits for the outcome, raises DeviceError if it fails.
+        with return_exceptions a plug that failed maps to its DeviceError instead
+        """
+        for plug in states:
+            if plug not in self.config['plugs']:
+                raise UnknownDeviceError(f"{plug} not in config")
+        if self.logger is not None:
+            self.logger.debug(f"cmd = set {json.dumps(states)}")
+        return await self.driver.acall(self.commands.execute(states,return_exceptions=return_exceptions))
+
+    async def alookup_command(self,token):
+        """ outcome of a pending command token, None when it is unknown """
+        async def lookup():
+            return self.commands.lookup(token)
+        return await self.driver.acall(lookup())
+
+    async def aon(self,plug):
+        return await self.aset_state(plug,1)
+
+    async def aoff(self,plug):
+        return await self.aset_state(plug,0)
+
+    def set_state(self,plug,state):
+        return self.driver.call(self.aset_state(plug,state))
+
+    def on(self,plug):
+        return self.set_state(plug,1)
+
+    def off(self,plug):
+        return self.set_state(plug,0)
+
+    def close(self):
+        if self.driver is not None:
+            self.driver.call(self.driver.close())
     
-    def has_events(self,plug):
-        key = f"{self.config['name']}/{plug}"
-        count=0
-        with self.get_conn() as conn:
-            count_query = "SELECT count(id) FROM events WHERE device_key = ?"
-            cur = conn.cursor()
-            count = cur.execute(count_query,(key,)).fetchone()[0]
-        return count>0
+    def get_key(self,plug):
+        return f"{self.config['name']}/{plug}"
+
+    def has_events(self,plug,cur=None):
+        if cur is None:
+            return self.store.has_events(self.get_key(plug),self.get_conn().cursor())
+        return self.store.has_events(self.get_key(plug),cur)
 
     def get_default_state(self,plug):
         default = None
@@ -243,138 +479,278 @@ class SmartStrip():
                     self.logger.debug(f"{plug} default = {default}")
         return 1 if default=='on' else 0
 
-    def get_expected_state(self,plug):
-        state = self.get_default_state(plug)
-        key = f"{self.config['name']}/{plug}"
-        with self.get_conn() as conn:
-            get_events_query="SELECT current_state FROM events WHERE device_key = ? ORDER BY event_at ASC LIMIT 1"
-            cur = conn.cursor()
-            # retrieve events
-            state = cur.execute(get_events_query,(key,)).fetchone()[0]
-        return int(state)
+    def get_expected_state(self,plug,cur=None):
+        if cur is None:
+            state = self.store.get_expected_state(self.get_key(plug),self.get_conn().cursor())
+        else:
+            state = self.store.get_expected_state(self.get_key(plug),cur)
+        return self.get_default_state(plug) if state is None else state
 
-    def get_current_state(self,plug):
+    async def aget_current_state(self,plug):
         if plug not in self.config['plugs']:
             raise UnknownDeviceError(f"{plug} not in config")        
-        status = self.status()
+        status = await self.astatus()
+        if status is None:
+            raise DeviceError(f"{self.config['name']} state is not available")
         if plug in status:
             return status[plug]
         raise UnknownDeviceError(f"{plug} not valid")
 
-    def put(self,plug,current_state,event,event_at):
-        key = f"{self.config['name']}/{plug}"
-        insert_event_query = "INSERT INTO events (device_key,current_state,event,event_at) VALUES(?,?,?,?)"
-        with self.get_conn() as conn:
-            cur = conn.cursor()
-            cur.execute(insert_event_query,(key,current_state,json.dumps(event),event_at))
-            conn.commit()
-
-    def pop(self,plug,time_mark):
-        key = f"{self.config['name']}/{plug}"
-        events = []
-        # start transaction
-        get_events_query="SELECT device_key,event,event_at FROM events WHERE device_key = ? and event_at <= ? ORDER BY event_at DESC"
-        delete_events_query="DELETE FROM events WHERE device_key = ? and event_at <= ?"
-        with self.get_conn() as conn:
-            cur = conn.cursor()
-            cur.execute('BEGIN TRANSACTION')
-
-            # retrieve events
-            events.extend(cur.execute(get_events_query,(key,time_mark)).fetchall())
-            # delete retrieve events
-            cur.execute(delete_events_query,(key,time_mark))
-
-        conn.commit()
-        return events   #[(device_key,event,event_at),...]
+    def get_current_state(self,plug):
+        return self.driver.call(self.aget_current_state(plug))
+
+    @metrics.timed('put')
+    def put(self,plug,current_state,event,event_at,cur=None):
+        if cur is not None:
+            self.store.put(self.get_key(plug),current_state,event,event_at,cur)
+            return
+        with self.store.transaction() as cur:
+            self.store.put(self.get_key(plug),current_state,event,event_at,cur)
+
+    def get_next_events(self):
+        """ returns {plug: event_at} of the earliest queued event of every plug """
+        prefix = self.get_key('')
+        return {key[len(prefix):]:event_at for key,event_at in self.store.get_next_events(prefix).items()}
+
+    def get_pending_events(self,limit=1000):
+        """ returns the queued events of every plug, [{'device_key','current_state','event','event_at'},...] """
+        return self.store.get_pending(self.get_key(''),limit=limit)
+
+    def get_queue_depth(self):
+        """ returns {plug: pending event count} """
+        prefix = self.get_key('')
+        return {key[len(prefix):]:count for key,count in self.store.get_queue_depth(prefix).items()}
+
+    def get_scheduled_plugs(self):
+        """ plugs the scheduler fires, none on a device with `scheduler: false` """
+        if not self.config.get('scheduler',True):
+            return []
+        return [plug for plug,plug_config in self.config['plugs'].items() if 'schedule' in plug_config]
+
+    @metrics.timed('pop')
+    def pop(self,plug,time_mark,cur=None):
+        if cur is not None:
+            # caller owns the transaction
+            return self.store.pop(self.get_key(plug),time_mark,cur)
+        with self.store.transaction() as cur:
+            return self.store.pop(self.get_key(plug),time_mark,cur)   #[(device_key,event,event_at),...]
     
     def parse_duration(self,time_span):
-        # time_span format is 00:15:00 interpreted as hours:minutes:seconds
-        # convert time span into seconds
-        time_parts = [int(p) for p in time_span.split(':')]
-        if len(time_parts) !=3:
-            raise ConfigurationError(f"time_span is not valid.  Expected format `HH:MM:SS` got {time_span}")
-        return int(time_parts[0]*60*60)+int(time_parts[1]*60)+time_parts[2]   
+        try:
+            return parse_duration(time_span)
+        except ScheduleError as err:
+            raise ConfigurationError(str(err)) from err
          
     def next_event(self,plug_name,current_state,now:int):
-        if plug_name not in self.config['plugs']:
-            return None
-        if 'schedule' not in self.config['plugs'][plug_name]:
+        schedule = self.schedules.get(plug_name)
+        if schedule is None:
             return None
-        schedule = self.config['plugs'][plug_name]['schedule']
-        if schedule['type'] != 'repeating':
-            if self.logger is not None:
-                self.logger.error(f"schedule type {schedule['type']} is not supported")
-
-        key = f"{self.config['name']}/{plug_name}"
-        duration = 0
-        if current_state == 1:
-            event = {'set':0}
-            duration = self.parse_duration(schedule['cycle_on'])
-        if current_state == 0:
-            event = {'set':1}
-            duration = self.parse_duration(schedule['cycle_off'])
-        event_at = now + duration
-        return (event,event_at)
+        # repeating schedules count from the state entered at `now`, daily schedules use the clock
+        state,event_at = schedule.next_transition(now,since=(current_state,now))
+        return ({'set':state},event_at)
 
-    def handle(self,plug_name,time_mark):
-        if self.logger is not None:
-            self.logger.info(f"handling {plug_name} @ {time_mark}")
-        if plug_name not in self.config['plugs']:
-            raise UnknownDeviceError(f"{plug_name} not valid")
-        # default_state = self.get_default_state(plug_name)
-        # expected_state = self.get_expected_state(plug_name)
-        # current_state = self.get_current_state(plug_name)
+    def get_scheduled_state(self,plug_name,time_mark):
+        """ state a plug should be in at time_mark when it has no queued events """
+        schedule = self.schedules.get(plug_name)
+        if isinstance(schedule,DailySchedule):
+            return schedule.state_at(time_mark)
+        return self.get_default_state(plug_name)
+
+    def dequeue_plug(self,cur,plug_name,time_mark):
         # check to see if there are events for the device
-        if not self.has_events(plug_name):
+        if not self.has_events(plug_name,cur=cur):
             # no events for device.  add first event
-            current_state = self.get_default_state(plug_name)         
-            event,event_at = self.next_event(plug_name,current_state,time_mark)
-            self.put(plug_name,current_state,event,event_at)
-            if current_state == 1:
-                result = self.on(plug_name)
-                if self.logger is not None:
-                    self.logger.info(result)
-                return result
-            else:
-                result = self.off(plug_name)
-                if self.logger is not None:
-                    self.logger.info(result)
-                return result
+            current_state = self.get_scheduled_state(plug_name,time_mark)
+            queue_event = self.next_event(plug_name,current_state,time_mark)
+            if queue_event is None:
+                # unscheduled plugs hold their default state, compare with the device before writing
+                return current_state,False
+            self.put(plug_name,current_state,*queue_event,cur=cur)
+            self.store.record(self.get_key(plug_name),current_state,{'set':current_state},time_mark,cur)
+            return current_state,True
 
         # device has events, pop event
-        expected_state = self.get_expected_state(plug_name)
-        plug_events = self.pop(plug_name,time_mark)
+        expected_state = self.get_expected_state(plug_name,cur=cur)
+        plug_events = self.pop(plug_name,time_mark,cur=cur)
         if plug_events is not None and len(plug_events)>0:
             retrieved_event = plug_events[0] # events are sorted .  only [0] needs to be processed
             if self.logger is not None:
                 self.logger.info(f"retrieved_event: {retrieved_event}")
-            device_key = retrieved_event[0]
             event = json.loads(retrieved_event[1])
             expected_state = event['set']
-            event_at = retrieved_event[2]
-            queue_event,queue_event_at = self.next_event(plug_name,expected_state,event_at)
-            self.put(plug_name,expected_state,queue_event,queue_event_at)
-        current_state = self.get_current_state(plug_name)
-        if current_state != expected_state:
-            if expected_state == 1:
-                result = self.on(plug_name)
-                if self.logger is not None:
-                    self.logger.info(result)
-                return result
-            else:
-                result = self.off(plug_name)
-                if self.logger is not None:
-                    self.logger.info(result)
-                return result
+            schedule = self.schedules.get(plug_name)
+            if schedule is not None:
+                # an overdue event is fast-forwarded to time_mark, replaying it from its own event_at would queue transitions in the past
+                since = (expected_state,retrieved_event[2])
+                expected_state = schedule.state_at(time_mark,since=since)
+                state,event_at = schedule.next_transition(time_mark,since=since)
+                self.put(plug_name,expected_state,{'set':state},event_at,cur=cur)
+                if expected_state != event['set']:
+                    self.store.record(self.get_key(plug_name),expected_state,{'set':expected_state},time_mark,cur)
+        return expected_state,False
+
+    def rebase_plug(self,cur,plug_name,time_mark):
+        """ returns the state plug_name should be in at time_mark and rebuilds its queue from time_mark onward.
+        a repeating cycle keeps its phase: it is anchored on the earliest queued event, or else on the last recorded one
+        """
+        key = self.get_key(plug_name)
+        schedule = self.schedules.get(plug_name)
+        if schedule is None:
+            self.store.clear(key,cur)
+            return self.get_default_state(plug_name)
+        last = self.store.last_recorded(key,time_mark,cur)
+        pending = self.store.peek(key,cur)
+        if pending is not None:
+            since = (pending[1]['set'],pending[2])
+        elif last is not None:
+            since = last
+        else:
+            since = (self.get_scheduled_state(plug_name,time_mark),time_mark)
+        intended = schedule.state_at(time_mark,since=since)
+        state,event_at = schedule.next_transition(time_mark,since=since)
+        self.store.clear(key,cur)
+        self.store.put(key,intended,{'set':state},event_at,cur)
+        if last is None or last[0] != intended:
+            self.store.record(key,intended,{'set':intended},time_mark,cur)
+        return intended
+
+    @metrics.timed('rebase')
+    def rebase_all(self,time_mark):
+        """ rebases the queue of every plug to time_mark in a single transaction, returns {plug: (intended_state, False)} """
+        results = {}
+        with self.queue_lock:
+            with self.store.transaction() as cur:
+                for plug_name in self.config['plugs']:
+                    results[plug_name] = (self.rebase_plug(cur,plug_name,time_mark),False)
+        return results
+
+    @metrics.timed('dequeue')
+    def dequeue_all(self,plug_names,time_mark):
+        """ advances the event queues of plug_names up to time_mark in a single transaction.
+        returns {plug: (expected_state, force)}, force is set when the plug has not been handled before
+        """
+        results = {}
+        with self.queue_lock:
+            with self.store.transaction() as cur:
+                for plug_name in plug_names:
+                    results[plug_name] = self.dequeue_plug(cur,plug_name,time_mark)
+        return results
+
+    def dequeue(self,plug_name,time_mark):
+        return self.dequeue_all([plug_name],time_mark)[plug_name]
+
+    @metrics.timed('handle')
+    async def ahandle(self,plug_name,time_mark):
+        if self.logger is not None:
+            self.logger.info(f"handling {plug_name} @ {time_mark}")
+        if plug_name not in self.config['plugs']:
+            raise UnknownDeviceError(f"{plug_name} not valid")
+        # queue work is blocking sqlite I/O, keep it off the event loop
+        expected_state,force = await asyncio.to_thread(self.dequeue,plug_name,time_mark)
+        if not force:
+            current_state = await self.aget_current_state(plug_name)
+        if force or current_state != expected_state:
+            result = await self.aset_state(plug_name,expected_state)
+            if self.logger is not None:
+                self.logger.info(result)
+            return result
         if self.logger is not None:
             self.logger.info(json.dumps({plug_name:current_state}))    
         return {plug_name:current_state}
 
-    def get_events_df(self):    
-        with self.get_conn() as conn:
-            # Execute an SQL query and store the result in a DataFrame
-            return pd.read_sql_query("SELECT * FROM events", conn)
-        return None
+    def handle(self,plug_name,time_mark):
+        return self.driver.call(self.ahandle(plug_name,time_mark))
+
+    @metrics.timed('handle_all')
+    async def ahandle_all(self,time_mark,plugs=None):
+        """ reconciles every plug (or `plugs`) with one queue transaction, one device read and one batched write.
+        returns {'plugs': {plug: {...}}, 'timings': {...}}
+        """
+        started = time.perf_counter()
+        plug_names = list(self.config['plugs']) if plugs is None else list(plugs)
+        for plug_name in plug_names:
+            if plug_name not in self.config['plugs']:
+                raise UnknownDeviceError(f"{plug_name} not valid")
+        if self.logger is not None:
+            self.logger.info(f"handling {','.join(plug_names)} @ {time_mark}")
+        queue = await asyncio.to_thread(self.dequeue_all,plug_names,time_mark)
+        return await self.aapply(queue,started)
+
+    @metrics.timed('recover')
+    async def arecover(self,time_mark):
+        """ brings every plug to the state its schedule intends at time_mark after downtime, same result shape as ahandle_all """
+        started = time.perf_counter()
+        if self.logger is not None:
+            self.logger.info(f"recovering @ {time_mark}")
+        queue = await asyncio.to_thread(self.rebase_all,time_mark)
+        return await self.aapply(queue,started)
+
+    async def aapply(self,queue,started):
+        """ applies {plug: (expected_state, force)} with one device read and one batched write """
+        dequeued = time.perf_counter()
+
+        status = None
+        if not all(force for _,force in queue.values()):
+            status = await self.astatus()
+        read = time.perf_counter()
+
+        changes = {}
+        errors = {}
+        for plug_name,(expected_state,force) in queue.items():
+            if status is not None and plug_name not in status:
+                # renamed on the device or a typo in the config, the rest of the strip is still applied
+                errors[plug_name] = str(PlugNotFoundError([plug_name],self.config['name']))
+            # without a device read every plug is written, setting a state is idempotent
+            elif force or status is None or status.get(plug_name) != expected_state:
+                changes[plug_name] = expected_state
+        if len(changes)>0:
+            try:
+                outcomes = await self.aset_states(changes,return_exceptions=True)
+            except DeviceError as err:
+                outcomes = {plug_name:err for plug_name in changes}
+            for plug_name,outcome in outcomes.items():
+                if isinstance(outcome,BaseException):
+                    errors[plug_name] = str(outcome)
+        written = time.perf_counter()
+
+        results = {}
+        for plug_name,(expected_state,force) in queue.items():
+            # changed only when the write went through, a failed one reports its error
+            written_plug = plug_name in changes
+            results[plug_name] = {
+                'state': expected_state,
+                'previous': status.get(plug_name) if status is not None else None,
+                'changed': written_plug and plug_name not in errors,
+                'error': errors.get(plug_name),
+                'elapsed_ms': round(((written if written_plug else read)-started)*1000,3),
+            }
+        if self.logger is not None:
+            self.logger.info(json.dumps(results))
+        return {
+            'plugs': results,
+            'timings': {
+                'queue_ms': round((dequeued-started)*1000,3),
+                'read_ms': round((read-dequeued)*1000,3),
+                'write_ms': round((written-read)*1000,3),
+                'total_ms': round((written-started)*1000,3),
+            },
+        }
+
+    def handle_all(self,time_mark,plugs=None):
+        return self.driver.call(self.ahandle_all(time_mark,plugs=plugs))
+
+    def query_events(self,plug=None,start=None,end=None,after=None,limit=100,descending=True):
+        """ returns a page of handled events: {'events': [...], 'next': cursor of the next page or None} """
+        plugs = list(self.config['plugs']) if plug is None else [plug]
+        events = self.store.query_history([self.get_key(p) for p in plugs],start=start,end=end,after=after,limit=limit,descending=descending)
+        cursor = (events[-1]['event_at'],events[-1]['id']) if len(events)==limit else None
+        return {'events':events,'next':cursor}
+
+    def get_on_time(self,start,end,plug=None,bucket=3600):
+        """ returns {plug: [(bucket_start, on_seconds),...]}, aggregated in SQLite """
+        end = min(end,time.time())
+        plugs = list(self.config['plugs']) if plug is None else [plug]
+        return {p:self.store.on_time(self.get_key(p),start,end,bucket=bucket) for p in plugs}
 
 # def run(cmd,plug=None):
 #     logger = logging.getLogger(__name__)
@@ -0,0 +1,319 @@
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+class EventStore():
+    """ SQLite storage shared by every device that uses the same `db_path`.
+
+    `events` holds pending transitions only, popped events move to the append-only
+    `event_history` table.  Both are indexed on (device_key, event_at).  The
+    database runs in WAL mode and every thread gets its own connection.
+    """
+    schema_version = 2
+    ddl=[
+        """
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY,
+            device_key VARCHAR(255) NOT NULL,
+            current_state INTEGER NOT NULL,
+            event_at REAL NOT NULL,
+            event VARCHAR(255) NOT NULL,
+            created_at REAL DEFAULT (strftime('%s', 'now')),
+            created_by INTEGER DEFAULT 1,
+            updated_at REAL DEFAULT (strftime('%s', 'now')),
+            updated_by INTEGER DEFAULT 1
+        );
+        """,
+        # current_state is included so the expected state lookup is answered from the index
+        "CREATE INDEX IF NOT EXISTS idx_events_device_key_event_at ON events(device_key,event_at,current_state);",
+        """
+        CREATE TABLE IF NOT EXISTS event_history (
+            id INTEGER PRIMARY KEY,
+            device_key VARCHAR(255) NOT NULL,
+            state INTEGER NOT NULL,
+            event_at REAL NOT NULL,
+            event VARCHAR(255) NOT NULL,
+            applied_at REAL DEFAULT (strftime('%s', 'now'))
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_event_history_device_key_event_at ON event_history(device_key,event_at);",
+        # version 2: coordination of several API workers, see cluster.py
+        """
+        CREATE TABLE IF NOT EXISTS leases (
+            name VARCHAR(255) PRIMARY KEY,
+            holder VARCHAR(255) NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS state_snapshot (
+            device VARCHAR(255) PRIMARY KEY,
+            states TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY,
+            action VARCHAR(32) NOT NULL,
+            device VARCHAR(255),
+            plug VARCHAR(255),
+            state INTEGER,
+            status VARCHAR(16) NOT NULL DEFAULT 'pending',
+            result TEXT,
+            error TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_outbox_status ON outbox(status,id);",
+    ]
+    pragmas = [
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA busy_timeout=5000",
+    ]
+    stores = {}
+    stores_lock = threading.Lock()
+
+    def __init__(self,db_path,logger=None):
+        self.db_path = Path(db_path)
+        self.logger = logger
+        self.local = threading.local()
+
+    @classmethod
+    def get(cls,db_path,logger=None):
+        """ returns the store for db_path, initializing the database on first use """
+        key = str(Path(db_path).resolve())
+        with cls.stores_lock:
+            if key not in cls.stores:
+                store = cls(db_path,logger=logger)
+                store.init_db()
+                cls.stores[key] = store
+            return cls.stores[key]
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_path)
+        for pragma in self.pragmas:
+            conn.execute(pragma)
+        return conn
+
+    def get_conn(self):
+        # sqlite3 connections can not be shared across threads, keep one per thread
+        conn = getattr(self.local,'conn',None)
+        if conn is None:
+            conn = self.connect()
+            self.local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """ yields a cursor inside BEGIN IMMEDIATE, commits on success and rolls back on error """
+        conn = self.get_conn()
+        cur = conn.cursor()
+        cur.execute('BEGIN IMMEDIATE')
+        try:
+            yield cur
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+    def init_db(self):
+        if not self.db_path.exists():
+            if self.logger is not None:
+                self.logger.info(f"initializing devices db at {self.db_path}")
+            self.db_path.parent.mkdir(parents=True,exist_ok=True)
+        conn = self.get_conn()
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= self.schema_version:
+            return
+        if self.logger is not None:
+            self.logger.info(f"{self.db_path} schema version {version}, migrating to {self.schema_version} ...")
+        with self.transaction() as cur:
+            tables = [row[0] for row in cur.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()]
+            if version < 1 and 'events' in tables:
+                # version 0 declared device_key UNIQUE, which a queue can not have.  rebuild the table
+                cur.execute("ALTER TABLE events RENAME TO events_v0")
+                self.create_db(cur)
+                cur.execute("""
+                    INSERT INTO events (id,device_key,current_state,event_at,event,created_at,created_by,updated_at,updated_by)
+                    SELECT id,device_key,current_state,event_at,event,created_at,created_by,updated_at,updated_by FROM events_v0
+                """)
+                cur.execute("DROP TABLE events_v0")
+            else:
+                # later versions only add tables
+                self.create_db(cur)
+            cur.execute(f"PRAGMA user_version={self.schema_version}")
+
+    def create_db(self,cur):
+        for stmt in self.ddl:
+            cur.execute(stmt)
+
+    def has_events(self,key,cur):
+        return cur.execute("SELECT 1 FROM events WHERE device_key = ? LIMIT 1",(key,)).fetchone() is not None
+
+    def get_expected_state(self,key,cur):
+        row = cur.execute("SELECT current_state FROM events WHERE device_key = ? ORDER BY event_at ASC LIMIT 1",(key,)).fetchone()
+        return None if row is None else int(row[0])
+
+    def put(self,key,current_state,event,event_at,cur):
+        cur.execute("INSERT INTO events (device_key,current_state,event,event_at) VALUES(?,?,?,?)",(key,current_state,json.dumps(event),event_at))
+
+    def peek(self,key,cur):
+        """ returns the earliest queued (current_state, event, event_at) of key or None """
+        row = cur.execute("SELECT current_state,event,event_at FROM events WHERE device_key = ? ORDER BY event_at ASC LIMIT 1",(key,)).fetchone()
+        return None if row is None else (int(row[0]),json.loads(row[1]),row[2])
+
+    def clear(self,key,cur):
+        cur.execute("DELETE FROM events WHERE device_key = ?",(key,))
+
+    def last_recorded(self,key,time_mark,cur):
+        """ returns (state, event_at) of the latest history row of key at or before time_mark, or None """
+        row = cur.execute("SELECT state,event_at FROM event_history WHERE device_key = ? AND event_at <= ? ORDER BY event_at DESC LIMIT 1",(key,time_mark)).fetchone()
+        return None if row is None else (int(row[0]),row[1])
+
+    def record(self,key,state,event,event_at,cur):
+        cur.execute("INSERT INTO event_history (device_key,state,event,event_at) VALUES(?,?,?,?)",(key,state,json.dumps(event),event_at))
+
+    def pop(self,key,time_mark,cur):
+        """ removes events due by time_mark from the queue and appends them to the history """
+        events = cur.execute("SELECT device_key,event,event_at FROM events WHERE device_key = ? and event_at <= ? ORDER BY event_at DESC",(key,time_mark)).fetchall()
+        if len(events)>0:
+            cur.executemany("INSERT INTO event_history (device_key,state,event,event_at) VALUES(?,?,?,?)",
+                [(device_key,json.loads(event)['set'],event,event_at) for device_key,event,event_at in events])
+            cur.execute("DELETE FROM events WHERE device_key = ? and event_at <= ?",(key,time_mark))
+        return events   #[(device_key,event,event_at),...]
+
+    def get_next_events(self,prefix):
+        """ returns {device_key: event_at} of the earliest queued event of every key starting with prefix """
+        rows = self.get_conn().execute("SELECT device_key,min(event_at) FROM events WHERE device_key >= ? AND device_key < ? GROUP BY device_key",(prefix,prefix+'\uffff')).fetchall()
+        return dict(rows)
+
+    def get_queue_depth(self,prefix):
+        """ returns {device_key: pending event count} for every key starting with prefix """
+        rows = self.get_conn().execute("SELECT device_key,count(*) FROM events WHERE device_key >= ? AND device_key < ? GROUP BY device_key",(prefix,prefix+'\uffff')).fetchall()
+        return dict(rows)
+
+    def get_pending(self,prefix,limit=1000):
+        """ returns the queued events of every key starting with prefix, in (device_key, event_at) order """
+        cur = self.get_conn().execute("SELECT device_key,current_state,event,event_at FROM events WHERE device_key >= ? AND device_key < ? ORDER BY device_key,event_at LIMIT ?",(prefix,prefix+'\uffff',limit))
+        columns = [column[0] for column in cur.description]
+        return [dict(zip(columns,row)) for row in cur.fetchall()]
+
+    def query_history(self,keys,start=None,end=None,after=None,limit=100,descending=True):
+        """ returns one page of event_history rows for keys with start <= event_at < end.
+        pages are keyed on (event_at, id): pass the last row's (event_at, id) as `after` to get the next page
+        """
+        order = "DESC" if descending else "ASC"
+        clauses = [f"device_key IN ({','.join('?'*len(keys))})"]
+        args = list(keys)
+        if start is not None:
+            clauses.append("event_at >= ?")
+            args.append(start)
+        if end is not None:
+            clauses.append("event_at < ?")
+            args.append(end)
+        if after is not None:
+            clauses.append(f"(event_at,id) {'<' if descending else '>'} (?,?)")
+            args.extend(after)
+        query = f"SELECT id,device_key,state,event,event_at,applied_at FROM event_history WHERE {' AND '.join(clauses)} ORDER BY event_at {order},id {order} LIMIT ?"
+        args.append(limit)
+        cur = self.get_conn().execute(query,args)
+        columns = [column[0] for column in cur.description]
+        return [dict(zip(columns,row)) for row in cur.fetchall()]
+
+    def on_time(self,key,start,end,bucket=3600):
+        """ returns [(bucket_start, on_seconds),...] for key between start and end.
+        intervals are built from the last event before start onward, so the cost depends on the window, not on the history size
+        """
+        query = """
+            WITH RECURSIVE
+            window_events AS (
+                SELECT state,event_at FROM event_history
+                WHERE device_key = :key
+                AND event_at >= coalesce((SELECT max(event_at) FROM event_history WHERE device_key = :key AND event_at <= :start),:start)
+                AND event_at < :end
+            ),
+            intervals AS (
+                SELECT state,max(event_at,:start) AS s,min(coalesce(lead(event_at) OVER (ORDER BY event_at),:end),:end) AS e FROM window_events
+            ),
+            split(bucket,s,e) AS (
+                SELECT CAST(s / :bucket AS INTEGER) * :bucket,s,e FROM intervals WHERE state = 1 AND e > s
+                UNION ALL
+                SELECT bucket + :bucket,bucket + :bucket,e FROM split WHERE bucket + :bucket < e
+            )
+            SELECT bucket,SUM(min(e,bucket + :bucket) - s) FROM split GROUP BY bucket ORDER BY bucket
+        """
+        return self.get_conn().execute(query,{'key':key,'start':start,'end':end,'bucket':bucket}).fetchall()
+
+    def acquire_lease(self,name,holder,ttl):
+        """ takes lease `name` when it is free or expired, or renews it for its holder.  returns True while holder owns it """
+        now = time.time()
+        with self.transaction() as cur:
+            cur.execute("""
+                INSERT INTO leases (name,holder,expires_at) VALUES(?,?,?)
+                ON CONFLICT(name) DO UPDATE SET holder=excluded.holder,expires_at=excluded.expires_at
+                WHERE leases.holder = excluded.holder OR leases.expires_at < ?
+            """,(name,holder,now+ttl,now))
+            row = cur.execute("SELECT holder FROM leases WHERE name = ?",(name,)).fetchone()
+        return row is not None and row[0] == holder
+
+    def release_lease(self,name,holder):
+        with self.transaction() as cur:
+            cur.execute("DELETE FROM leases WHERE name = ? AND holder = ?",(name,holder))
+
+    def get_lease(self,name):
+        """ returns (holder, expires_at) or None """
+        return self.get_conn().execute("SELECT holder,expires_at FROM leases WHERE name = ?",(name,)).fetchone()
+
+    def put_snapshot(self,device,states):
+        with self.transaction() as cur:
+            cur.execute("INSERT OR REPLACE INTO state_snapshot (device,states,updated_at) VALUES(?,?,?)",(device,json.dumps(states),time.time()))
+
+    def get_snapshots(self):
+        """ returns {device: ({plug: state}, updated_at)} """
+        rows = self.get_conn().execute("SELECT device,states,updated_at FROM state_snapshot").fetchall()
+        return {device:(json.loads(states),updated_at) for device,states,updated_at in rows}
+
+    def enqueue_command(self,action,device=None,plug=None,state=None):
+        now = time.time()
+        with self.transaction() as cur:
+            cur.execute("INSERT INTO outbox (action,device,plug,state,created_at,updated_at) VALUES(?,?,?,?,?,?)",(action,device,plug,state,now,now))
+            return cur.lastrowid
+
+    def claim_commands(self,limit=50):
+        """ marks up to limit pending commands as running and returns them, oldest first """
+        with self.transaction() as cur:
+            cur.execute("SELECT id,action,device,plug,state FROM outbox WHERE status = 'pending' ORDER BY id LIMIT ?",(limit,))
+            columns = [column[0] for column in cur.description]
+            rows = [dict(zip(columns,row)) for row in cur.fetchall()]
+            if len(rows)>0:
+                cur.executemany("UPDATE outbox SET status = 'running',updated_at = ? WHERE id = ?",[(time.time(),row['id']) for row in rows])
+        return rows
+
+    def finish_command(self,command_id,status,result=None,error=None):
+        with self.transaction() as cur:
+            cur.execute("UPDATE outbox SET status = ?,result = ?,error = ?,updated_at = ? WHERE id = ?",(status,json.dumps(result),error,time.time(),command_id))
+
+    def get_command(self,command_id):
+        row = self.get_conn().execute("SELECT id,action,device,plug,state,status,result,error FROM outbox WHERE id = ?",(command_id,)).fetchone()
+        if row is None:
+            return None
+        command = dict(zip(["id","action","device","plug","state","status","result","error"],row))
+        command['result'] = json.loads(command['result']) if command['result'] is not None else None
+        return command
+
+    def purge_commands(self,before):
+        """ drops finished commands last updated before `before` """
+        with self.transaction() as cur:
+            cur.execute("DELETE FROM outbox WHERE status IN ('done','failed') AND updated_at < ?",(before,))
+
+    def requeue_commands(self):
+        """ returns commands a previous leader claimed but never finished to the queue, commands are idempotent """
+        with self.transaction() as cur:
+            cur.execute("UPDATE outbox SET status = 'pending',updated_at = ? WHERE status = 'running'",(time.time(),))
+            return cur.rowcount
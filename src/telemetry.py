@@ -0,0 +1,326 @@
+import asyncio
+import os
+import shutil
+import threading
+import time
+import numpy as np
+from datetime import date,datetime,timedelta
+from pathlib import Path
+from schedule import get_timezone
+
+sample_dtype = np.dtype([('at','f8'),('plug','i2'),('state','i1'),('power','f4'),('dt','f4')])
+
+# bucket seconds and the period of the file a bucket is stored in
+resolutions = {
+    'minute': (60,'%Y-%m-%d'),
+    'hour': (3600,'%Y-%m'),
+    'day': (86400,'%Y'),
+}
+
+epoch = date(1970,1,1)
+
+rollup_columns = ['samples','seconds','on_seconds','power_samples','power_sum','power_max','energy_wh']
+
+def local_offsets(at,timezone):
+    """ utc offset in seconds of every epoch in `at`.  offsets only change on the hour, so they are looked up once per hour """
+    hours,inverse = np.unique((at//3600).astype(np.int64),return_inverse=True)
+    offsets = np.array([datetime.fromtimestamp(hour*3600,timezone).utcoffset().total_seconds() for hour in hours])
+    return offsets[inverse]
+
+def rollup(samples,plugs,bucket,timezone):
+    """ aggregates samples into `bucket` second buckets aligned to local time, returns {column: array} """
+    offsets = local_offsets(samples['at'],timezone)
+    if bucket == 86400:
+        # a local day is 23 or 25 hours long on DST changes, anchor it on local midnight
+        days,inverse = np.unique(((samples['at']+offsets)//86400).astype(np.int64),return_inverse=True)
+        starts = np.array([datetime.combine(epoch+timedelta(days=int(day)),datetime.min.time(),timezone).timestamp() for day in days])[inverse]
+    else:
+        starts = ((samples['at']+offsets)//bucket)*bucket-offsets
+    order = np.lexsort((starts,samples['plug']))
+    samples = samples[order]
+    starts = starts[order]
+    first = np.flatnonzero(np.concatenate(([True],(np.diff(samples['plug'])!=0)|(np.diff(starts)!=0))))
+    power = samples['power'].astype(np.float64)
+    metered = ~np.isnan(power)
+    power = np.where(metered,power,0.0)
+    dt = samples['dt'].astype(np.float64)
+    return {
+        'plug':np.array(plugs,dtype=object)[samples['plug'][first]],
+        'bucket':starts[first],
+        'samples':np.diff(np.append(first,len(samples))),
+        'seconds':np.add.reduceat(dt,first),
+        'on_seconds':np.add.reduceat(dt*samples['state'],first),
+        'power_samples':np.add.reduceat(metered.astype(np.int64),first),
+        'power_sum':np.add.reduceat(power,first),
+        'power_max':np.maximum.reduceat(power,first),
+        'energy_wh':np.add.reduceat(power*dt,first)/3600,
+    }
+
+def merge(table):
+    """ combines rows of the same plug and bucket, rollups of disjoint samples add up """
+    aggregates = [(column,'max' if column == 'power_max' else 'sum') for column in rollup_columns]
+    merged = table.group_by(['plug','bucket']).aggregate(aggregates)
+    names = {f"{column}_{aggregate}":column for column,aggregate in aggregates}
+    return merged.rename_columns([names.get(name,name) for name in merged.column_names]).sort_by([('plug','ascending'),('bucket','ascending')])
+
+def write_atomic(table,path):
+    import pyarrow.parquet as pq
+    path.parent.mkdir(parents=True,exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    pq.write_table(table,tmp_path)
+    os.replace(tmp_path,path)
+
+class TelemetryStore():
+    """ Plug state and power samples of one device.
+
+    Samples go to a numpy ring buffer of `capacity` rows and are flushed to
+    Parquet every `flush_interval` seconds:
+
+        {path}/{device}/raw/{day}/{first sample}.parquet
+        {path}/{device}/minute/{day}.parquet
+        {path}/{device}/hour/{month}.parquet
+        {path}/{device}/day/{year}.parquet
+
+    Rollups hold sums (seconds, on_seconds, power_sum, energy_wh, ...) and
+    maxima so a flush merges into them, and queries read rollups only: a
+    year at daily resolution is one small file.  Each rollup file records the
+    time of the last sample merged into it, a flush retried after a failure
+    skips what a file already holds.  Raw samples are kept for
+    `raw_days` days.  A buffer that fills up before it is flushed loses its oldest samples.
+    """
+
+    def __init__(self,device,plugs,path,timezone,capacity=4096,flush_interval=600,raw_days=30,logger=None):
+        self.device = device
+        self.plugs = list(plugs)
+        self.plug_ids = {plug:i for i,plug in enumerate(self.plugs)}
+        self.path = Path(path)/device
+        self.timezone = get_timezone(timezone)
+        self.flush_interval = flush_interval
+        self.raw_days = raw_days
+        self.logger = logger
+        self.buffer = np.zeros(capacity,dtype=sample_dtype)
+        self.count = 0
+        self.flushed = 0
+        self.flushed_at = time.monotonic()
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+    def append(self,at,states,power,dt):
+        """ adds one sample per plug in states, power is {plug: watts} for metered plugs """
+        with self.lock:
+            for plug,state in states.items():
+                if plug not in self.plug_ids:
+                    continue
+                self.buffer[self.count % len(self.buffer)] = (at,self.plug_ids[plug],state,power.get(plug,np.nan),dt)
+                self.count += 1
+
+    def pending(self):
+        """ copy of the samples not flushed yet, oldest first """
+        with self.lock:
+            first = max(self.flushed,self.count-len(self.buffer))
+            lost = first-self.flushed
+            samples = self.buffer[np.arange(first,self.count) % len(self.buffer)]
+            return samples,lost,self.count
+
+    def due(self):
+        return time.monotonic()-self.flushed_at >= self.flush_interval or self.count-self.flushed >= len(self.buffer)*3//4
+
+    def flush(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        with self.flush_lock:
+            samples,lost,count = self.pending()
+            self.flushed_at = time.monotonic()
+            if lost > 0 and self.logger is not None:
+                self.logger.warning(f"telemetry buffer of {self.device} overflowed, {lost} samples lost")
+            if len(samples) == 0:
+                with self.lock:
+                    self.flushed = count
+                return 0
+            local_days = ((samples['at']+local_offsets(samples['at'],self.timezone))//86400).astype(np.int64)
+            for day in np.unique(local_days):
+                day_samples = samples[local_days == day]
+                table = pa.table({
+                    'at':day_samples['at'],
+                    'plug':np.array(self.plugs,dtype=object)[day_samples['plug']],
+                    'state':day_samples['state'],
+                    'power':day_samples['power'],
+                    'dt':day_samples['dt'],
+                })
+                write_atomic(table,self.path/'raw'/str(epoch+timedelta(days=int(day)))/f"{day_samples['at'][0]:.3f}.parquet")
+            days,inverse = np.unique(local_days,return_inverse=True)
+            for resolution,(bucket,period) in resolutions.items():
+                # buckets never span two files, a sample goes to the file of its local day
+                periods = np.array([(epoch+timedelta(days=int(day))).strftime(period) for day in days])[inverse]
+                for name in np.unique(periods):
+                    file_path = self.path/resolution/f"{name}.parquet"
+                    part = samples[periods == name]
+                    existing = None
+                    if file_path.exists():
+                        existing = pq.read_table(file_path)
+                        metadata = existing.schema.metadata or {}
+                        if b'flushed_at' in metadata:
+                            part = part[part['at'] > float(metadata[b'flushed_at'])]
+                    if len(part) == 0:
+                        continue
+                    table = pa.table(rollup(part,self.plugs,bucket,self.timezone))
+                    if existing is not None:
+                        table = pa.concat_tables([existing.replace_schema_metadata(None),table.cast(existing.schema.remove_metadata())])
+                    write_atomic(merge(table).replace_schema_metadata({'flushed_at':repr(float(part['at'].max()))}),file_path)
+            with self.lock:
+                self.flushed = count
+            self.expire()
+            return len(samples)
+
+    def expire(self):
+        raw = self.path/'raw'
+        if not raw.exists():
+            return
+        cutoff = (datetime.now(self.timezone)-timedelta(days=self.raw_days)).strftime('%Y-%m-%d')
+        for day in raw.iterdir():
+            if day.name < cutoff:
+                shutil.rmtree(day,ignore_errors=True)
+
+    def files(self,resolution,start,end):
+        """ rollup files that may hold buckets between start and end """
+        bucket,period = resolutions[resolution]
+        names = set()
+        t = start-bucket
+        step = {'minute':86400,'hour':86400*28,'day':86400*365}[resolution]
+        while t < end+step:
+            names.add(datetime.fromtimestamp(min(t,end),self.timezone).strftime(period))
+            t += step
+        return [path for path in (self.path/resolution/f"{name}.parquet" for name in sorted(names)) if path.exists()]
+
+    def query(self,start,end,plug=None,resolution=None):
+        """ returns {'resolution': ..., 'rows': [{plug, bucket, duty_cycle, on_seconds, power_mean, power_max, energy_wh, samples},...]}
+        the resolution defaults to minutes up to 2 days, hours up to 90 days and days beyond
+        """
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+        if resolution is None:
+            span = end-start
+            resolution = 'minute' if span <= 2*86400 else 'hour' if span <= 90*86400 else 'day'
+        if resolution not in resolutions:
+            raise ValueError(f"resolution {resolution} is not one of {', '.join(resolutions)}")
+        tables = [pq.read_table(path) for path in self.files(resolution,start,end)]
+        samples,_,_ = self.pending()
+        if len(samples) > 0:
+            # samples not flushed yet are rolled up on the fly
+            tables.append(pa.table(rollup(samples,self.plugs,resolutions[resolution][0],self.timezone)))
+        if len(tables) == 0:
+            return {'resolution':resolution,'rows':[]}
+        table = pa.concat_tables([table.cast(tables[0].schema) for table in tables])
+        mask = pc.and_(pc.greater_equal(table['bucket'],start),pc.less(table['bucket'],end))
+        if plug is not None:
+            mask = pc.and_(mask,pc.equal(table['plug'],plug))
+        table = merge(table.filter(mask))
+        rows = []
+        for row in table.to_pylist():
+            rows.append({
+                'plug':row['plug'],
+                'bucket':row['bucket'],
+                'duty_cycle':row['on_seconds']/row['seconds'] if row['seconds'] > 0 else None,
+                'on_seconds':row['on_seconds'],
+                'power_mean':row['power_sum']/row['power_samples'] if row['power_samples'] > 0 else None,
+                'power_max':row['power_max'] if row['power_samples'] > 0 else None,
+                'energy_wh':row['energy_wh'] if row['power_samples'] > 0 else None,
+                'samples':row['samples'],
+            })
+        return {'resolution':resolution,'rows':rows}
+
+class Telemetry():
+    """ Samples every device that has a `telemetry` section and stores the samples in its TelemetryStore.
+
+        telemetry:
+            interval: 60            # seconds between samples
+            emeter: true            # read power where the strip has an energy meter
+            flush_interval: 600     # seconds between Parquet flushes
+            raw_days: 30            # days raw samples are kept
+            path: /var/data/telemetry   # defaults to a telemetry folder next to db_path
+    """
+
+    def __init__(self,fleet,logger=None):
+        self.fleet = fleet
+        self.logger = logger
+        self.stores = {}
+        self.tasks = {}
+        self.running = False
+        for name,strip in fleet.strips.items():
+            if strip.config.get('telemetry') is not None:
+                self.stores[name] = self.create_store(name,strip)
+
+    def create_store(self,name,strip):
+        settings = strip.config['telemetry']
+        path = settings.get('path',Path(strip.config['db_path']).parent/'telemetry')
+        return TelemetryStore(name,strip.config['plugs'],path,strip.config['timezone'],
+            flush_interval=float(settings.get('flush_interval',600)),raw_days=int(settings.get('raw_days',30)),logger=self.logger)
+
+    def get(self,device):
+        return self.stores.get(device)
+
+    async def sample(self,name,previous_at=None):
+        strip = self.fleet.get(name)
+        settings = strip.config['telemetry']
+        interval = float(settings.get('interval',60))
+        states = await strip.astatus()
+        at = time.time()
+        if states is None:
+            return None
+        power = await strip.aread_emeter() if settings.get('emeter',True) else {}
+        # a sample stands for the time since the previous one, gaps from outages count as one interval at most
+        dt = min(at-previous_at,2*interval) if previous_at is not None else interval
+        self.stores[name].append(at,states,power,dt)
+        return at
+
+    async def run_device(self,name):
+        interval = float(self.fleet.get(name).config['telemetry'].get('interval',60))
+        store = self.stores[name]
+        previous_at = None
+        while True:
+            try:
+                previous_at = await self.sample(name,previous_at) or previous_at
+                if store.due():
+                    await asyncio.to_thread(store.flush)
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                if self.logger is not None:
+                    self.logger.error(f"telemetry {name}: {err}")
+            await asyncio.sleep(interval)
+
+    def start(self):
+        self.running = True
+        for name in self.stores:
+            if name not in self.tasks:
+                self.tasks[name] = asyncio.create_task(self.run_device(name))
+
+    async def cancel(self,name):
+        task = self.tasks.pop(name,None)
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def stop(self):
+        self.running = False
+        for name in list(self.tasks):
+            await self.cancel(name)
+        for store in self.stores.values():
+            await asyncio.to_thread(store.flush)
+
+    async def reload(self,devices):
+        """ rebuilds the stores of devices whose config changed after flushing what they buffered """
+        for name in devices:
+            await self.cancel(name)
+            store = self.stores.pop(name,None)
+            if store is not None:
+                await asyncio.to_thread(store.flush)
+            strip = self.fleet.strips.get(name)
+            if strip is not None and strip.config.get('telemetry') is not None:
+                self.stores[name] = self.create_store(name,strip)
+                if self.running:
+                    self.tasks[name] = asyncio.create_task(self.run_device(name))